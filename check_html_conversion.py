@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import argparse
+import difflib
+import os
+from typing import Iterator
+
+from utils.html_markdown import html_to_markdown
+
+# HTML documents with the markdown expected for them next to them (<name>.md). The committed .md files were written by
+# hand after Joplin's conversion conventions, they are approximations until replaced with --record from a real Joplin
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'html-corpus')
+
+
+def get_corpus_files(paths: list[str]) -> Iterator[str]:
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for file in sorted(files):
+                    if file.lower().endswith(('.html', '.htm')):
+                        yield os.path.join(root, file)
+        else:
+            yield path
+
+
+def get_expected_file(file: str) -> str:
+    return os.path.splitext(file)[0] + '.md'
+
+
+def convert_with_joplin(html: str) -> str:
+    # Only imported when needed, the offline check runs without Joplin
+    from service.joplin_api import convert_html_with_joplin
+    return convert_html_with_joplin(html)
+
+
+def normalize(markdown: str) -> str:
+    # Only trailing spaces and the blank lines around the document are ignored
+    return '\n'.join(line.rstrip() for line in markdown.strip('\n').splitlines())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the local HTML to markdown conversion with the expected "
+                                                 "markdown in <name>.md, or with Joplin's own conversion (--live)")
+    parser.add_argument('paths', nargs='*', default=[CORPUS_DIR],
+                        help="HTML files or directories of .html files making up the corpus (default: html-corpus)")
+    parser.add_argument('--live', action='store_true',
+                        help="convert with the running Joplin instead of using the <name>.md files")
+    parser.add_argument('--record', action='store_true',
+                        help="convert with the running Joplin and save the result as <name>.md next to each document")
+    parser.add_argument('--min-similarity', type=float, default=1.0,
+                        help="fail when a document converts less similar than this ratio (default: 1.0, identical)")
+    parser.add_argument('--diff', action='store_true', help="print a diff for every document that is not identical")
+    args = parser.parse_args()
+
+    failed = 0
+    for file in get_corpus_files(args.paths):
+        with open(file, 'r', encoding='utf-8', errors='replace') as f:
+            html = f.read()
+
+        expected_file = get_expected_file(file)
+        if args.live or args.record:
+            expected_markdown = convert_with_joplin(html)
+            if args.record:
+                with open(expected_file, 'w', encoding='utf-8') as f:
+                    f.write(expected_markdown.strip() + '\n')
+        elif os.path.exists(expected_file):
+            with open(expected_file, 'r', encoding='utf-8') as f:
+                expected_markdown = f.read()
+        else:
+            print(f"{file}: no expected markdown, run with --record or --live")
+            failed += 1
+            continue
+
+        expected = normalize(expected_markdown)
+        actual = normalize(html_to_markdown(html))
+        similarity = difflib.SequenceMatcher(None, expected, actual).ratio()
+        status = "identical" if expected == actual else f"{similarity:.3f}"
+        if similarity < args.min_similarity:
+            failed += 1
+            status += " FAILED"
+        print(f"{file}: {status}")
+
+        if args.diff and expected != actual:
+            source = 'joplin' if args.live or args.record else 'expected'
+            diff = difflib.unified_diff(expected.splitlines(), actual.splitlines(), source, 'local', lineterm='')
+            print('\n'.join(diff))
+
+    exit(1 if failed > 0 else 0)
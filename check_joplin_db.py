@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+import argparse
+import time
+from typing import Callable, Iterable
+
+from configuration import joplin_configs, kindle_configs, todoist_configs, trello_configs
+from service import joplin_api
+from service.joplin_db import JoplinDatabase
+
+
+class ApiReader:
+    """The listings used by the jobs, read through the REST API."""
+
+    def get_folders(self) -> list[dict]:
+        return list(joplin_api.get_items(joplin_api.FOLDERS_API_URL))
+
+    def get_tags(self) -> list[dict]:
+        return list(joplin_api.get_items(joplin_api.TAGS_API_URL))
+
+    def get_notes_in_folder(self, folder_id: str) -> list[dict]:
+        return list(joplin_api.get_items(joplin_api.FOLDERS_NOTES_API_URL.format(notebook_id=folder_id)))
+
+    def get_notes_with_tag(self, tag_id: str) -> list[dict]:
+        return list(joplin_api.get_items(joplin_api.TAG_NOTE_API_URL.format(tag_id=tag_id)))
+
+    def get_note_tags(self, note_id: str) -> list[dict]:
+        return list(joplin_api.get_items(joplin_api.NOTES_TAGS_API_URL.format(note_id=note_id)))
+
+    def get_note_resources(self, note_id: str) -> list[dict]:
+        return list(joplin_api.get_items(joplin_api.NOTES_RESOURCES_API_URL.format(note_id=note_id)))
+
+
+class DatabaseReader:
+    """The listings used by the jobs, read from the Joplin database."""
+
+    def __init__(self, database: JoplinDatabase):
+        self.database = database
+
+    def get_folders(self) -> list[dict]:
+        return self.database.get_folders()
+
+    def get_tags(self) -> list[dict]:
+        return self.database.get_tags()
+
+    def get_notes_in_folder(self, folder_id: str) -> list[dict]:
+        return self.database.get_notes_in_folder(folder_id, joplin_api.NOTE_LISTING_FIELDS)
+
+    def get_notes_with_tag(self, tag_id: str) -> list[dict]:
+        return self.database.get_notes_with_tag(tag_id, joplin_api.NOTE_LISTING_FIELDS)
+
+    def get_note_tags(self, note_id: str) -> list[dict]:
+        return self.database.get_note_tags(note_id)
+
+    def get_note_resources(self, note_id: str) -> list[dict]:
+        return self.database.get_note_resources(note_id)
+
+
+def get_job_tag_names() -> set[str]:
+    names = {joplin_configs.get('ocr-tag'), joplin_configs.get('processed-tag'), kindle_configs.get('joplin-tag'),
+             todoist_configs.get('joplin-tag'), trello_configs.get('joplin-tag')}
+    return {name.lower() for name in names if name}
+
+
+def get_job_notebook_names() -> set[str]:
+    names = {kindle_configs.get('joplin-notebook'), todoist_configs.get('joplin-notebook'),
+             trello_configs.get('joplin-notebook')}
+    return {name.lower() for name in names if name}
+
+
+def run_listing_pass(reader) -> int:
+    """Reads what one run of the Joplin jobs lists: tags, notebooks, the notes of the job tags and notebooks and the
+    tags and resources of each of those notes once. Returns the number of items read."""
+    tag_names = get_job_tag_names()
+    notebook_names = get_job_notebook_names()
+    tags = reader.get_tags()
+    folders = reader.get_folders()
+    notes = {}
+    for tag in tags:
+        if tag['title'].lower() in tag_names:
+            notes.update((note['id'], note) for note in reader.get_notes_with_tag(tag['id']))
+    for folder in folders:
+        if folder['title'].lower() in notebook_names:
+            notes.update((note['id'], note) for note in reader.get_notes_in_folder(folder['id']))
+
+    count = len(tags) + len(folders) + len(notes)
+    for note in notes.values():
+        count += len(reader.get_note_tags(note['id'])) + len(reader.get_note_resources(note['id']))
+    return count
+
+
+def compare(name: str, api_items: Iterable[dict], db_items: Iterable[dict], fields: Iterable[str]) -> bool:
+    api_items = {item['id']: item for item in api_items}
+    db_items = {item['id']: item for item in db_items}
+    ok = True
+    for item_id in api_items.keys() - db_items.keys():
+        print(f" {name}: {item_id} only returned by the API")
+        ok = False
+    for item_id in db_items.keys() - api_items.keys():
+        print(f" {name}: {item_id} only found in the database")
+        ok = False
+    for item_id in api_items.keys() & db_items.keys():
+        for field in fields:
+            if api_items[item_id].get(field) != db_items[item_id].get(field):
+                print(f" {name}: {item_id} differs in {field}: API {api_items[item_id].get(field)!r}, "
+                      f"database {db_items[item_id].get(field)!r}")
+                ok = False
+    return ok
+
+
+def check_consistency(api: ApiReader, db: DatabaseReader) -> bool:
+    print("Checking the Joplin database against the API")
+    note_fields = joplin_api.NOTE_LISTING_FIELDS.split(',')
+    ok = compare("folders", api.get_folders(), db.get_folders(), ['parent_id', 'title'])
+    ok = compare("tags", api.get_tags(), db.get_tags(), ['parent_id', 'title']) and ok
+
+    note_ids = set()
+    for tag in api.get_tags():
+        api_notes = api.get_notes_with_tag(tag['id'])
+        note_ids.update(note['id'] for note in api_notes)
+        ok = compare(f"notes with tag {tag['title']}", api_notes, db.get_notes_with_tag(tag['id']), note_fields) and ok
+    for folder in api.get_folders():
+        api_notes = api.get_notes_in_folder(folder['id'])
+        note_ids.update(note['id'] for note in api_notes)
+        ok = compare(f"notes in {folder['title']}", api_notes, db.get_notes_in_folder(folder['id']), note_fields) and ok
+
+    resource_fields = ['title', 'mime', 'filename', 'file_extension', 'size', 'updated_time']
+    for note_id in sorted(note_ids):
+        ok = compare(f"tags of note {note_id}", api.get_note_tags(note_id), db.get_note_tags(note_id), ['title']) and ok
+        ok = compare(f"resources of note {note_id}", api.get_note_resources(note_id), db.get_note_resources(note_id),
+                     resource_fields) and ok
+
+    print(" Consistent" if ok else " Differences found")
+    return ok
+
+
+def benchmark(name: str, listing_pass: Callable[[], int], runs: int) -> None:
+    timings = []
+    count = 0
+    for _ in range(runs):
+        start = time.perf_counter()
+        count = listing_pass()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    print(f" {name}: {count} items, best {timings[0] * 1000:.1f} ms, median {timings[len(timings) // 2] * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the Joplin database read backend against the REST API")
+    parser.add_argument('--database', default=joplin_configs.get('database'),
+                        help="path to the database.sqlite of the Joplin profile (default: joplin.database)")
+    parser.add_argument('--benchmark', type=int, metavar='RUNS', default=0,
+                        help="also time the listings of one run of the jobs with each backend")
+    args = parser.parse_args()
+
+    if not args.database:
+        parser.error("no Joplin database configured, set joplin.database or pass --database")
+
+    api_reader = ApiReader()
+    db_reader = DatabaseReader(JoplinDatabase(args.database))
+    consistent = check_consistency(api_reader, db_reader)
+
+    if args.benchmark > 0:
+        print(f"Listing time per run over {args.benchmark} runs")
+        benchmark("REST API", lambda: run_listing_pass(api_reader), args.benchmark)
+        benchmark("Database", lambda: run_listing_pass(db_reader), args.benchmark)
+
+    exit(0 if consistent else 1)
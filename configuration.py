@@ -12,3 +12,9 @@ with open(config_file_path, "r") as yml_file:
     todoist_configs = configs['todoist']
     kindle_configs = configs['kindle']
     trello_configs = configs['trello']
+    daemon_configs = configs['daemon'] if 'daemon' in configs else {}
+    html_configs = configs['html-conversion'] if 'html-conversion' in configs else {}
+    attachment_index_configs = configs['attachment-index'] if 'attachment-index' in configs else {}
+    health_configs = configs['health'] if 'health' in configs else {}
+
+state_dir = configs['state-dir'] if 'state-dir' in configs and configs['state-dir'] else config_dir
@@ -8,3 +8,13 @@ class MimeType(Enum):
     PDF = 3
     IMG = 4
     OTHER = 5
+
+
+@unique
+class FetchMode(Enum):
+    # Parsed EmailMessage
+    FULL = 1
+    # Headers and BODYSTRUCTURE, parts are fetched on demand
+    PARTIAL = 2
+    # Original RFC822 bytes with only the headers parsed
+    RAW = 3
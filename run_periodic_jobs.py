@@ -1,116 +1,219 @@
 #!/usr/bin/env python
 
+import argparse
 import datetime
+import functools
+import queue
+import threading
+import time
 import traceback
 from email.message import EmailMessage
-from io import BytesIO, StringIO
-from typing import List
+from typing import Callable, NamedTuple, Optional
 
 from todoist_api_python.models import Comment
 
 import service
 from configuration import joplin_configs, mail_configs, kindle_configs, todoist_configs, trello_configs, \
-    obsidian_configs
+    obsidian_configs, daemon_configs, health_configs
 from constants import LOCAL_TZ
-from enums import MimeType
+from enums import FetchMode, MimeType
 from service import obsidian_api
-from service.joplin_api import JoplinNote
+from service.joplin_api import JoplinNote, Resource, Tag
 from service.todoist_api import get_all_projects, create_project, add_task, add_file_comment, get_label, \
     get_tasks_with_label, complete_task, get_task_comments, get_project, get_project_tasks, add_comment
-from utils.mail import fetch_mail, send_mail, archive_mail, get_subject, get_title_from_subject, \
-    get_tags_from_subject, get_notebook_from_subject, determine_mime_type, get_email_body
+from utils.attachment import open_attachment
+from utils.concurrency import run_concurrently
+from utils.health import CircuitBreaker
+from utils.kindle import kindle_planner
+from utils.lazy_mail import LazyEmailMessage
+from utils.mail import MailSession, MailboxWatcher, RawEmailMessage, send_mail, send_raw_mail, smtp_session, \
+    get_subject, get_title_from_subject, get_tags_from_subject, get_notebook_from_subject, determine_mime_type, \
+    get_email_body
 from utils.ocr import get_image_full_text
 from utils.pdf import get_pdf_full_text
+from utils.state import JsonStateStore
 
 FILTERED_JOPLIN_TAGS = [joplin_configs['processed-tag']]  # , todoist_configs['joplin-tag']]
 
+DEFAULT_DAEMON_INTERVAL = 15 * 60
+DEFAULT_DAEMON_POLL_INTERVAL = 60
+JOPLIN_DELIVERIES_FILE = 'joplin-deliveries.json'
 
-def forward_mail():
-    print("Processing Mail Forwarding")
+todoist_project_lock = threading.Lock()
+joplin_deliveries: Optional[JsonStateStore] = None
+joplin_deliveries_lock = threading.Lock()
 
-    for account in mail_configs['accounts']:
-        print(f" Handling account '{account['name']}'")
-
-        forwarding_map = account['mail-forward']
-        for mailbox, email in forwarding_map.items():
-            messages = fetch_mail(account['imap']['server'], account['imap']['port'], account['username'],
-                                  account['password'], mailbox)
-            for uid, msg in messages.items():
-                try:
-                    print(f"  Forwarding '{get_subject(msg)}' in {mailbox} mailbox")
-                    send_mail(msg, email)
-                    if mail_configs['archive']:
-                        print("  Archiving message")
-                        archive_mail(account['imap']['server'], account['imap']['port'], account['username'],
-                                     account['password'], mailbox, uid,
-                                     account['archive-folder'] if 'archive-folder' in account else None)
-                except Exception as exc:
-                    raise RuntimeError(f"Error: Mail '{get_subject(msg)}' could not be forwarded: {str(exc)}") from exc
-
-
-def process_joplin_email_mailbox() -> None:
-    print("Processing Joplin emails")
+joplin_health = CircuitBreaker('Joplin', service.joplin_api.ping, health_configs)
+todoist_health = CircuitBreaker('Todoist', service.todoist_api.ping, health_configs)
+service_health = [joplin_health, todoist_health]
+
+MailHandler = Callable[[MailSession, int, EmailMessage | LazyEmailMessage | RawEmailMessage], None]
+
+
+class MailRoute(NamedTuple):
+    mailbox: str
+    handler: MailHandler
+    fetch_mode: FetchMode
+    # Services the handler writes to, the mailbox is left alone while one of them is unavailable
+    services: tuple[CircuitBreaker, ...] = ()
 
+
+def process_mail() -> None:
+    print("Processing Mail")
+    account_routes = []
     for account in mail_configs['accounts']:
-        print(f" Handling account '{account['name']}'")
-        messages = fetch_mail(account['imap']['server'], account['imap']['port'], account['username'],
-                              account['password'], joplin_configs['mailbox'])
-        for uid, msg in messages.items():
-            subject = get_subject(msg)
-            print(f"  Moving '{subject}' to Joplin")
+        routes = []
+        for route in get_mailbox_routes(account).values():
+            unavailable = [breaker.name for breaker in route.services if not breaker.is_available()]
+            if len(unavailable) > 0:
+                print(f" Skipping mailbox {route.mailbox} of account '{account['name']}', "
+                      f"{', '.join(unavailable)} unavailable")
+                continue
+            routes.append(route)
+        account_routes.append((account, routes))
+    process_account_mailboxes(account_routes)
+
+
+def get_mailbox_routes(account: dict) -> dict[str, MailRoute]:
+    """Compiles the routing table of an account: which handler processes each of its mailboxes."""
+    # Forwarding passes the original bytes through when raw-forward is on, notes only fetch the parts they use when
+    # partial-fetch is on
+    forward_mode = FetchMode.RAW if mail_configs.get('raw-forward', True) else FetchMode.FULL
+    note_mode = FetchMode.PARTIAL if mail_configs.get('partial-fetch', False) else FetchMode.FULL
+    routes = {mailbox: MailRoute(mailbox, functools.partial(forward_email, email=email), forward_mode)
+              for mailbox, email in account['mail-forward'].items()}
+
+    for route in (MailRoute(joplin_configs['mailbox'], add_email_to_joplin, note_mode, (joplin_health,)),
+                  MailRoute(obsidian_configs['mailbox'], add_email_to_obsidian, note_mode)):
+        if route.mailbox in routes:
+            print(f"Warning: mailbox {route.mailbox} of account '{account['name']}' is configured more than once, "
+                  f"ignoring the {route.handler.__name__} route")
+            continue
+        routes[route.mailbox] = route
 
-            try:
-                title = get_title_from_subject(subject)
-                tags = get_tags_from_subject(subject)
-                notebook_name = get_notebook_from_subject(subject)
-                body, content_type = get_email_body(msg)
-                notebook = service.joplin_api.get_notebook(notebook_name)
+    return routes
+
+
+def process_account_mailboxes(account_routes: list[tuple[dict, list[MailRoute]]]) -> None:
+    # Accounts are processed in parallel with up to max-connections sessions each, every mailbox stays on one session
+    # so its messages are still handled in order
+    tasks = []
+    for account, routes in account_routes:
+        pending = queue.Queue()
+        for route in routes:
+            pending.put(route)
+
+        connections = min(account.get('max-connections', 1), len(routes))
+        tasks.extend(functools.partial(process_account_routes, account, pending) for _ in range(connections))
 
-                note = service.joplin_api.create_new_note(title, body, notebook_id=notebook['id'],
-                                       is_html=(content_type == 'text/html'))
+    raise_errors(run_concurrently(tasks, mail_configs.get('max-workers', 1)))
 
-                service.joplin_api.add_note_tags(note, tags)
 
-                add_email_attachments_to_joplin_note(msg, note)
+def process_account_routes(account: dict, pending: queue.Queue) -> None:
+    print(f" Handling account '{account['name']}'")
 
-                if mail_configs['archive']:
-                    print("  Archiving message")
-                    archive_mail(account['imap']['server'], account['imap']['port'], account['username'],
-                                 account['password'], joplin_configs['mailbox'], uid,
-                                 account['archive-folder'] if 'archive-folder' in account else None)
+    errors = []
+    with MailSession(account) as session:
+        while True:
+            try:
+                route = pending.get_nowait()
+            except queue.Empty:
+                break
+
+            try:
+                process_mailbox(session, route.mailbox, route.handler, route.fetch_mode)
             except Exception as exc:
-                raise RuntimeError(f"Error: Mail '{subject}' could not be added: {str(exc)}") from exc
+                # The rest of this mailbox waits for the next run, other mailboxes carry on
+                print(f"  {str(exc)}")
+                errors.append(exc)
 
+    raise_errors(errors)
 
-def process_obsidian_email_mailbox() -> None:
-    print("Processing Obsidian emails")
 
-    for account in mail_configs['accounts']:
-        print(f" Handling account '{account['name']}'")
-        messages = fetch_mail(account['imap']['server'], account['imap']['port'], account['username'],
-                              account['password'], obsidian_configs['mailbox'])
+def raise_errors(errors: list[Exception]) -> None:
+    if len(errors) == 1:
+        raise errors[0]
+    elif len(errors) > 1:
+        raise RuntimeError(f"{len(errors)} errors occurred:\n" + "\n".join(str(error) for error in errors))
+
+
+def process_mailbox(session: MailSession, mailbox: str, handler: MailHandler,
+                    fetch_mode: FetchMode = FetchMode.FULL) -> None:
+    if not session.has_new_mail(mailbox):
+        return
+
+    session.select(mailbox)
+    for messages in session.fetch_batches(mode=fetch_mode):
         for uid, msg in messages.items():
-            subject = get_subject(msg)
-            print(f"  Moving '{subject}' to Obsidian")
+            handler(session, uid, msg)
 
-            try:
-                title = get_title_from_subject(subject)
-                tags = get_tags_from_subject(subject)
-                notebook_name = get_notebook_from_subject(subject)
-                body, content_type = get_email_body(msg)
 
-                path, filename = obsidian_api.create_new_note(title, body, path=notebook_name,
-                                                              is_html=(content_type == 'text/html'), tags=tags)
+def forward_email(session: MailSession, uid: int, msg: EmailMessage | RawEmailMessage, email: str) -> None:
+    try:
+        print(f"  Forwarding '{get_subject(msg)}' in {session.mailbox} mailbox")
+        if isinstance(msg, RawEmailMessage):
+            send_raw_mail(msg.raw, email)
+        else:
+            send_mail(msg, email)
+        session.mark_processed(uid)
+        if mail_configs['archive']:
+            print("  Archiving message")
+            session.archive(uid)
+    except Exception as exc:
+        session.mark_failed()
+        raise RuntimeError(f"Error: Mail '{get_subject(msg)}' could not be forwarded: {str(exc)}") from exc
 
-                add_email_attachments_to_obsidian_note(msg, path, filename)
 
-                if mail_configs['archive']:
-                    print("  Archiving message")
-                    archive_mail(account['imap']['server'], account['imap']['port'], account['username'],
-                                 account['password'], obsidian_configs['mailbox'], uid,
-                                 account['archive-folder'] if 'archive-folder' in account else None)
-            except Exception as exc:
-                raise RuntimeError(f"Error: Mail '{subject}' could not be added: {str(exc)}") from exc
+def add_email_to_joplin(session: MailSession, uid: int, msg: EmailMessage | LazyEmailMessage) -> None:
+    subject = get_subject(msg)
+    print(f"  Moving '{subject}' to Joplin")
+
+    try:
+        title = get_title_from_subject(subject)
+        tags = get_tags_from_subject(subject)
+        notebook_name = get_notebook_from_subject(subject)
+        body, content_type = get_email_body(msg)
+        notebook = service.joplin_api.get_notebook(notebook_name)
+
+        note = service.joplin_api.create_new_note(title, body, notebook_id=notebook['id'],
+                                                  is_html=(content_type == 'text/html'))
+
+        service.joplin_api.add_note_tags(note, tags)
+
+        with service.joplin_api.edit_note(note):
+            add_email_attachments_to_joplin_note(msg, note)
+
+        session.mark_processed(uid)
+        if mail_configs['archive']:
+            print("  Archiving message")
+            session.archive(uid)
+    except Exception as exc:
+        session.mark_failed()
+        raise RuntimeError(f"Error: Mail '{subject}' could not be added: {str(exc)}") from exc
+
+
+def add_email_to_obsidian(session: MailSession, uid: int, msg: EmailMessage | LazyEmailMessage) -> None:
+    subject = get_subject(msg)
+    print(f"  Moving '{subject}' to Obsidian")
+
+    try:
+        title = get_title_from_subject(subject)
+        tags = get_tags_from_subject(subject)
+        notebook_name = get_notebook_from_subject(subject)
+        body, content_type = get_email_body(msg)
+
+        path, filename = obsidian_api.create_new_note(title, body, path=notebook_name,
+                                                      is_html=(content_type == 'text/html'), tags=tags)
+
+        add_email_attachments_to_obsidian_note(msg, path, filename)
+
+        session.mark_processed(uid)
+        if mail_configs['archive']:
+            print("  Archiving message")
+            session.archive(uid)
+    except Exception as exc:
+        session.mark_failed()
+        raise RuntimeError(f"Error: Mail '{subject}' could not be added: {str(exc)}") from exc
 
 
 def add_email_attachments_to_joplin_note(email_message, note: JoplinNote):
@@ -121,13 +224,8 @@ def add_email_attachments_to_joplin_note(email_message, note: JoplinNote):
         else:
             file_name = part.get_filename(failobj="unknown_file_name")
             part_type = determine_mime_type(file_name, content_type)
-            content = part.get_content()
-            if isinstance(content, bytes):
-                with BytesIO(content) as f:
-                    service.joplin_api.add_attachment(note, file_name, f, part_type)
-            else:
-                with StringIO(content) as f:
-                    service.joplin_api.add_attachment(note, file_name, f, part_type)
+            with open_attachment(part, part_type) as f:
+                service.joplin_api.add_attachment(note, file_name, f, part_type)
 
 
 def add_email_attachments_to_obsidian_note(email_message, path: str, filename: str):
@@ -138,194 +236,215 @@ def add_email_attachments_to_obsidian_note(email_message, path: str, filename: s
         else:
             attachment_name = part.get_filename(failobj="unknown_file_name")
             part_type = determine_mime_type(attachment_name, content_type)
-            content = part.get_content()
-            if isinstance(content, bytes):
-                with BytesIO(content) as f:
-                    obsidian_api.add_attachment(path, filename, attachment_name, f, part_type)
-            else:
-                with StringIO(content) as f:
-                    obsidian_api.add_attachment(path, filename, attachment_name, f, part_type)
-
-
-def process_joplin_kindle_tag():
-    if 'joplin-tag' not in kindle_configs:
-        return
-
-    print("Processing Kindle tag in Joplin")
-    tag = service.joplin_api.get_tag(kindle_configs['joplin-tag'], auto_create=False)
-    if not tag:
-        print(f" Unable to find the Joplin tag {kindle_configs['joplin-tag']}")
-        return
-
-    notes = service.joplin_api.get_notes_with_tag(tag)
-    if len(notes) > 0:
-        send_notes_to_kindle(notes)
-
-
-def process_joplin_kindle_notebook():
-    if 'joplin-notebook' not in kindle_configs:
-        return
-
-    print("Processing Kindle notebook in Joplin")
-    notebook = service.joplin_api.get_notebook(kindle_configs['joplin-notebook'], default_on_missing=False, auto_create=False)
-    if not notebook:
-        print(f" Unable to find the Joplin notebook {kindle_configs['joplin-notebook']}")
-        return
-
-    notes = service.joplin_api.get_notes_in_notebook(notebook)
-    if len(notes) > 0:
-        send_notes_to_kindle(notes)
-
-
-def send_notes_to_kindle(notes: List[service.joplin_api.JoplinNote]):
-    for note in notes:
-        if service.joplin_api.is_processed(note):
+            with open_attachment(part, part_type) as f:
+                obsidian_api.add_attachment(path, filename, attachment_name, f, part_type)
+
+
+class JoplinRoute(NamedTuple):
+    """A destination that Joplin notes are sent to when they carry its tag or are in its notebook."""
+    name: str
+    configs: dict
+    send: Callable[[JoplinNote, list[Tag], list[Resource]], None]
+    services: tuple[CircuitBreaker, ...] = ()
+
+
+def get_joplin_routes() -> list[JoplinRoute]:
+    return [JoplinRoute('Kindle', kindle_configs, send_note_to_kindle),
+            JoplinRoute('Todoist', todoist_configs, send_note_to_todoist_from_joplin, (todoist_health,)),
+            JoplinRoute('Trello', trello_configs, send_note_to_trello)]
+
+
+def process_joplin_routes() -> bool:
+    """Sends the routed notes to their destinations. Returns False when notes were postponed because one of their
+    destinations is unavailable."""
+    print("Routing Joplin notes to Kindle, Todoist and Trello")
+    routes = get_joplin_routes()
+    routed_notes = []
+    postponed = 0
+    for note, note_routes in route_joplin_notes(routes):
+        if all(breaker.is_available() for route in note_routes for breaker in route.services):
+            routed_notes.append((note, note_routes))
+        else:
+            postponed += 1
+    if postponed > 0:
+        print(f" Postponing {postponed} notes with an unavailable destination")
+
+    # Each destination keeps its own limit of notes in flight, max-workers of its section
+    limits = {route.name: threading.BoundedSemaphore(route.configs.get('max-workers', 1)) for route in routes}
+    max_workers = max(route.configs.get('max-workers', 1) for route in routes)
+    tasks = [functools.partial(send_routed_note, note, note_routes, limits) for note, note_routes in routed_notes]
+    if max_workers > 1 and len(tasks) > 1 and not joplin_configs.get('delete-processed'):
+        # Create the processed tag up front instead of racing to create it from several workers
+        service.joplin_api.get_tag(joplin_configs['processed-tag'], auto_create=True)
+    raise_errors(run_concurrently(tasks, max_workers))
+    return postponed == 0
+
+
+def route_joplin_notes(routes: list[JoplinRoute]) -> list[tuple[JoplinNote, list[JoplinRoute]]]:
+    """Lists the notes of every configured tag and notebook once and collects the destinations of each note.
+
+    The listings are read completely up front, tagging or deleting processed notes would otherwise shift their pages.
+    """
+    trigger_notes: dict[tuple[str, str], Optional[list[JoplinNote]]] = {}
+    routed_notes: dict[str, tuple[JoplinNote, list[JoplinRoute]]] = {}
+    for route in routes:
+        for kind in ('tag', 'notebook'):
+            name = route.configs.get(f"joplin-{kind}")
+            if not name:
+                continue
+
+            trigger = (kind, name.lower())
+            if trigger not in trigger_notes:
+                trigger_notes[trigger] = get_trigger_notes(kind, name)
+            notes = trigger_notes[trigger]
+            if notes is None:
+                print(f" Unable to find the Joplin {kind} {name} of {route.name}")
+                continue
+
+            for note in notes:
+                if service.joplin_api.is_processed(note):
+                    continue
+                note_routes = routed_notes.setdefault(note['id'], (note, []))[1]
+                if route not in note_routes:
+                    note_routes.append(route)
+
+    return list(routed_notes.values())
+
+
+def get_trigger_notes(kind: str, name: str) -> Optional[list[JoplinNote]]:
+    if kind == 'tag':
+        tag = service.joplin_api.get_tag(name, auto_create=False)
+        return list(service.joplin_api.get_candidate_notes_with_tag(tag)) if tag else None
+
+    notebook = service.joplin_api.get_notebook(name, default_on_missing=False, auto_create=False)
+    return list(service.joplin_api.get_candidate_notes_in_notebook(notebook)) if notebook else None
+
+
+def get_joplin_deliveries() -> JsonStateStore:
+    global joplin_deliveries
+    with joplin_deliveries_lock:
+        if joplin_deliveries is None:
+            joplin_deliveries = JsonStateStore(JOPLIN_DELIVERIES_FILE)
+        return joplin_deliveries
+
+
+def send_routed_note(note: JoplinNote, routes: list[JoplinRoute], limits: dict[str, threading.BoundedSemaphore]):
+    """Sends a note to each of its destinations and marks it as processed once all of them succeeded.
+
+    The destinations that succeeded are remembered, so when another one failed the retry doesn't send the note to
+    them again.
+    """
+    print(f" Routing note '{note['title']}' to {', '.join(route.name for route in routes)}")
+    deliveries = get_joplin_deliveries()
+    delivered = deliveries.get(note['id'], [])
+    tags = service.joplin_api.get_note_tags(note)
+    resources = service.joplin_api.get_note_resources(note)
+
+    errors = []
+    for route in routes:
+        if route.name in delivered:
+            print(f"  Already sent to {route.name}")
             continue
 
         try:
-            msg = EmailMessage()
-            msg['Subject'] = note['title']
-
-            resources = service.joplin_api.get_note_resources(note)
-            for resource in resources:
-                # TODO check supported format
-                file_bytes = service.joplin_api.get_resource_file(resource['id'])
-                maintype, subtype = resource['mime'].split('/', 1)
-                msg.add_attachment(file_bytes, maintype=maintype, subtype=subtype, filename=resource['title'])
-
-            print(f" Sending note attachments to Kindle ")
-            send_mail(msg, kindle_configs['email'])
-            service.joplin_api.handle_processed_note(note)
+            with limits[route.name]:
+                route.send(note, tags, resources)
         except Exception as exc:
-            raise RuntimeError(f"Error: Note '{note['title']}' could not sent to Kindle: {str(exc)}") from exc
-
-
-def process_joplin_todoist_tag():
-    if 'joplin-tag' not in todoist_configs:
-        return
-
-    print("Processing Todoist tag in Joplin")
-    tag = service.joplin_api.get_tag(todoist_configs['joplin-tag'], auto_create=False)
-    if not tag:
-        print(f" Unable to find the Joplin tag {todoist_configs['joplin-tag']}")
-        return
+            errors.append(exc)
+            continue
 
-    notes = service.joplin_api.get_notes_with_tag(tag)
-    if len(notes) > 0:
-        send_notes_to_todoist_from_joplin(notes)
+        delivered = delivered + [route.name]
+        deliveries.set(note['id'], delivered)
+        deliveries.save()
+    raise_errors(errors)
 
+    service.joplin_api.handle_processed_note(note)
+    deliveries.delete(note['id'])
+    deliveries.save()
 
-def process_joplin_todoist_notebook():
-    if 'joplin-notebook' not in todoist_configs:
-        return
 
-    print("Processing Todoist notebook in Joplin")
-    notebook = service.joplin_api.get_notebook(todoist_configs['joplin-notebook'], default_on_missing=False, auto_create=False)
-    if not notebook:
-        print(f" Unable to find the Joplin notebook {todoist_configs['joplin-notebook']}")
-        return
+def send_note_to_kindle(note: JoplinNote, tags: list[Tag], resources: list[Resource]):
+    try:
+        plan = kindle_planner.plan(resources)
+        for resource, reason in plan.skipped:
+            print(f"  Not sending '{resource['title']}' to Kindle: {reason}")
+        if len(plan.messages) == 0:
+            print(" No documents to send to Kindle")
+            return
 
-    notes = service.joplin_api.get_notes_in_notebook(notebook)
-    if len(notes) > 0:
-        send_notes_to_todoist_from_joplin(notes)
+        for i, message_resources in enumerate(plan.messages, start=1):
+            msg = EmailMessage()
+            msg['Subject'] = note['title'] if len(plan.messages) == 1 else f"{note['title']} ({i}/{len(plan.messages)})"
 
+            for resource in message_resources:
+                with service.joplin_api.open_resource(resource) as f:
+                    file_bytes = f.read()
+                maintype, subtype = (resource['mime'] or 'application/octet-stream').split('/', 1)
+                msg.add_attachment(file_bytes, maintype=maintype, subtype=subtype,
+                                   filename=kindle_planner.get_attachment_name(resource))
 
-def send_notes_to_todoist_from_joplin(notes: List[service.joplin_api.JoplinNote]):
-    for note in notes:
-        if service.joplin_api.is_processed(note):
-            continue
-
-        print(f" Copying note '{note['title']}' as task")
-
-        due = None
-        if 'todo_due' in note and note['todo_due'] > 0:
-            dt = datetime.datetime.fromtimestamp(note['todo_due'] / 1000.0, tz=datetime.timezone.utc)
-            due = dt.astimezone(LOCAL_TZ)
-
-        content = note['title']
-        if len(note['source_url']) > 0:
-            content = f"[{content}]({note['source_url']})"
-
-        tags = service.joplin_api.get_note_tags(note)
-        labels = [tag['title'] for tag in tags if tag['title'] not in FILTERED_JOPLIN_TAGS]
-        projects = [label for label in labels if label.startswith('#')]
-        labels = list(set(labels) - set(projects))
-        project = None
-        if len(projects) > 0:
-            if len(projects) > 1:
-                print(f"  Warning: task {note['title']} has more than one project tag {projects}, using first")
-            proj_name = projects[0][1:]
+            print(f" Sending {len(message_resources)} note attachments to Kindle ")
+            send_mail(msg, kindle_configs['email'])
+    except Exception as exc:
+        raise RuntimeError(f"Error: Note '{note['title']}' could not sent to Kindle: {str(exc)}") from exc
+
+
+def send_note_to_todoist_from_joplin(note: JoplinNote, tags: list[Tag], resources: list[Resource]):
+    print(f" Copying note '{note['title']}' as task")
+
+    due = None
+    if 'todo_due' in note and note['todo_due'] > 0:
+        dt = datetime.datetime.fromtimestamp(note['todo_due'] / 1000.0, tz=datetime.timezone.utc)
+        due = dt.astimezone(LOCAL_TZ)
+
+    content = note['title']
+    if len(note['source_url']) > 0:
+        content = f"[{content}]({note['source_url']})"
+
+    labels = [tag['title'] for tag in tags if tag['title'] not in FILTERED_JOPLIN_TAGS]
+    projects = [label for label in labels if label.startswith('#')]
+    labels = list(set(labels) - set(projects))
+    project = None
+    if len(projects) > 0:
+        if len(projects) > 1:
+            print(f"  Warning: task {note['title']} has more than one project tag {projects}, using first")
+        proj_name = projects[0][1:]
+        # Notes sent in parallel must not each create the same new project
+        with todoist_project_lock:
             project = next((proj for proj in get_all_projects() if proj.name == proj_name), None)
             if project is None:
                 print(f"  Creating Todoist project '{proj_name}'")
                 project = create_project(proj_name)
 
-        task = add_task(content, due=due, labels=labels, project=project)
+    task = add_task(content, due=due, labels=labels, project=project)
 
-        if note['body'] and len(note['body']) > 0:
-            add_comment(task, note['body'])
+    if note['body'] and len(note['body']) > 0:
+        add_comment(task, note['body'])
 
-        add_comment(task, f"joplin://x-callback-url/openNote?id={note['id']}")
+    add_comment(task, f"joplin://x-callback-url/openNote?id={note['id']}")
 
-        resources = service.joplin_api.get_note_resources(note)
-        for resource in resources:
-            file_bytes = service.joplin_api.get_resource_file(resource['id'])
-            add_file_comment(task, file_bytes, resource['title'], resource['mime'])
+    for resource in resources:
+        with service.joplin_api.open_resource(resource) as f:
+            file_bytes = f.read()
+        add_file_comment(task, file_bytes, resource['title'], resource['mime'])
 
-        service.joplin_api.handle_processed_note(note)
 
+def send_note_to_trello(note: JoplinNote, tags: list[Tag], resources: list[Resource]):
+    try:
+        trello_msg = EmailMessage()
+        trello_msg['Subject'] = note['title']
 
-def process_joplin_trello_tag():
-    if 'joplin-tag' not in trello_configs:
-        return
-
-    print("Processing Trello tag in Joplin")
-    tag = service.joplin_api.get_tag(trello_configs['joplin-tag'], auto_create=False)
-    if not tag:
-        print(f" No Joplin tag {trello_configs['joplin-tag']}")
-        return
-
-    notes = service.joplin_api.get_notes_with_tag(tag)
-    if len(notes) > 0:
-        send_notes_to_trello(notes)
-
-
-def process_joplin_trello_notebook():
-    if 'joplin-notebook' not in trello_configs:
-        return
-
-    print("Processing Trello notebook in Joplin")
-    notebook = service.joplin_api.get_notebook(trello_configs['joplin-notebook'], default_on_missing=False, auto_create=False)
-    if not notebook:
-        print(f" No Joplin notebook {trello_configs['joplin-notebook']}")
-        return
-
-    notes = service.joplin_api.get_notes_in_notebook(notebook)
-    if len(notes) > 0:
-        send_notes_to_trello(notes)
+        for resource in resources:
+            with service.joplin_api.open_resource(resource) as f:
+                file_bytes = f.read()
+            maintype, subtype = resource['mime'].split('/', 1)
+            trello_msg.add_attachment(file_bytes, maintype=maintype, subtype=subtype, filename=resource['title'])
 
-
-def send_notes_to_trello(notes: List[service.joplin_api.JoplinNote]):
-    for note in notes:
-        if service.joplin_api.is_processed(note):
-            continue
-
-        try:
-            trello_msg = EmailMessage()
-            trello_msg['Subject'] = note['title']
-
-            resources = service.joplin_api.get_note_resources(note)
-            for resource in resources:
-                file_bytes = service.joplin_api.get_resource_file(resource['id'])
-                maintype, subtype = resource['mime'].split('/', 1)
-                trello_msg.add_attachment(file_bytes, maintype=maintype, subtype=subtype, filename=resource['title'])
-
-            print(f" Sending note to Trello ")
-            # TODO use Trello API
-            send_mail(trello_msg, trello_configs['email'])
-            service.joplin_api.handle_processed_note(note)
-        except Exception as exc:
-            raise RuntimeError(f"Error: Note '{note['title']}' could not sent to Kindle: {str(exc)}") from exc
+        print(f" Sending note to Trello ")
+        # TODO use Trello API
+        send_mail(trello_msg, trello_configs['email'])
+    except Exception as exc:
+        raise RuntimeError(f"Error: Note '{note['title']}' could not sent to Trello: {str(exc)}") from exc
 
 
 def process_joplin_ocr_tag():
@@ -335,20 +454,22 @@ def process_joplin_ocr_tag():
         print(f" No Joplin tag {joplin_configs['ocr-tag']}")
         return
 
-    notes = service.joplin_api.get_notes_with_tag(tag)
+    # Removing the OCR tag from the notes changes the listing, so it is read completely up front
+    notes = list(service.joplin_api.get_candidate_notes_with_tag(tag))
     for note in notes:
-        for resource in service.joplin_api.get_note_resources(note):
-            mime_type = determine_mime_type(resource['filename'], resource['mime'])
-            if mime_type == MimeType.IMG:
-                file = service.joplin_api.get_resource_file(resource['id'])
-                img_text = get_image_full_text(BytesIO(file))
-                if len(img_text.strip()) > 0:
-                    service.joplin_api.append_to_note(note, img_text)
-            elif mime_type == MimeType.PDF:
-                file = service.joplin_api.get_resource_file(resource['id'])
-                pdf_text = get_pdf_full_text(BytesIO(file))
-                if len(pdf_text.strip()) > 0:
-                    service.joplin_api.append_to_note(note, pdf_text)
+        with service.joplin_api.edit_note(note):
+            for resource in service.joplin_api.get_note_resources(note):
+                mime_type = determine_mime_type(resource['filename'], resource['mime'])
+                if mime_type == MimeType.IMG:
+                    with service.joplin_api.open_resource(resource) as f:
+                        img_text = get_image_full_text(f)
+                    if len(img_text.strip()) > 0:
+                        service.joplin_api.append_to_note(note, img_text)
+                elif mime_type == MimeType.PDF:
+                    with service.joplin_api.open_resource(resource) as f:
+                        pdf_text = get_pdf_full_text(f)
+                    if len(pdf_text.strip()) > 0:
+                        service.joplin_api.append_to_note(note, pdf_text)
 
         service.joplin_api.remove_note_tag(note, tag)
 
@@ -393,20 +514,21 @@ def process_todoist_joplin_tag():
 
             joplin_note = service.joplin_api.create_new_note(task.content, body, notebook_id=None, is_html=True, due_date=due)
 
-            for comment in get_task_comments(task):
-                service.joplin_api.append_to_note(joplin_note, get_todoist_comment_text(comment))
-
-            todoist_project = get_project(task.project_id)
-            child_items = [i for i in get_project_tasks(todoist_project) if i.project_id == task.id]
-            if len(child_items) > 0:
-                for child_item in child_items:
-                    append_note = 'Task: ' + child_item.content + " " + child_item.description
-                    for child_comment in get_task_comments(child_item):
-                        append_note += '\n' + get_todoist_comment_text(child_comment)
-                    service.joplin_api.append_to_note(joplin_note, append_note)
-                    item_to_remove = next((i for i in tasks if i.id == child_item.id), None)
-                    if item_to_remove is not None:
-                        tasks.remove(item_to_remove)
+            with service.joplin_api.edit_note(joplin_note):
+                for comment in get_task_comments(task):
+                    service.joplin_api.append_to_note(joplin_note, get_todoist_comment_text(comment))
+
+                todoist_project = get_project(task.project_id)
+                child_items = [i for i in get_project_tasks(todoist_project) if i.project_id == task.id]
+                if len(child_items) > 0:
+                    for child_item in child_items:
+                        append_note = 'Task: ' + child_item.content + " " + child_item.description
+                        for child_comment in get_task_comments(child_item):
+                            append_note += '\n' + get_todoist_comment_text(child_comment)
+                        service.joplin_api.append_to_note(joplin_note, append_note)
+                        item_to_remove = next((i for i in tasks if i.id == child_item.id), None)
+                        if item_to_remove is not None:
+                            tasks.remove(item_to_remove)
 
             service.joplin_api.add_note_tag(joplin_note, todoist_joplin_tag)
 
@@ -420,36 +542,125 @@ def process_todoist_joplin_tag():
             complete_task(task)
 
 
-print("Start: ", str(datetime.datetime.now()))
-print("===============================")
-
-try:
-    # Mail Handling
-    forward_mail()
-    process_joplin_email_mailbox()
-    process_obsidian_email_mailbox()
-
-    # Joplin Handling
-    process_joplin_ocr_tag()
-    process_joplin_kindle_tag()
-    process_joplin_kindle_notebook()
-    process_joplin_todoist_tag()
-    process_joplin_todoist_notebook()
-    process_joplin_trello_tag()
-    process_joplin_trello_notebook()
+def run_all_jobs() -> None:
+    print("Start: ", str(datetime.datetime.now()))
+    print("===============================")
+
+    service.joplin_api.invalidate_metadata_cache()
+    service.joplin_api.processed_notes.invalidate()
+    joplin_complete = False
+    try:
+        check_services()
+
+        # Mail Handling
+        obsidian_api.verify_attachment_index()
+        process_mail()
+
+        if joplin_health.is_available():
+            # Joplin Handling
+            service.joplin_api.change_feed.start_run()
+            service.joplin_api.verify_attachment_index()
+            process_joplin_ocr_tag()
+            joplin_complete = process_joplin_routes()
+
+            # Todoist Handling
+            if todoist_health.is_available():
+                process_todoist_joplin_tag()
+
+            if joplin_configs['auto-sync']:
+                print("Starting Joplin Sync")
+                service.joplin_api.sync()
+    except Exception as e:
+        send_error_report()
+        raise e
+
+    # Changes of postponed notes must still be seen by the next run
+    if joplin_complete:
+        service.joplin_api.change_feed.commit()
+    stats = service.joplin_api.client.get_stats()
+    print(f"Joplin API: {stats['requests']} requests over {stats['connections']} connections")
+    print("===============================")
+    print("End: ", str(datetime.datetime.now()))
+
+
+def check_services() -> None:
+    """Probes the services the jobs depend on, the jobs of unavailable ones are skipped for this run."""
+    for breaker in service_health:
+        breaker.check()
+
+    unavailable = [breaker for breaker in service_health if not breaker.is_available()]
+    for breaker in unavailable:
+        print(f"{breaker.name} is unavailable, skipping the jobs depending on it: {breaker.error}")
+    if any(breaker.just_opened for breaker in unavailable):
+        send_service_report(unavailable)
+
+
+def send_service_report(unavailable: list[CircuitBreaker]) -> None:
+    msg = EmailMessage()
+    msg['Subject'] = f"Automation Hub: {', '.join(breaker.name for breaker in unavailable)} unavailable"
+    msg.set_content("\n".join(f"{breaker.name}: {breaker.error}" for breaker in unavailable) +
+                    "\n\nThe jobs depending on them are skipped until they are available again.")
+    send_mail(msg, mail_configs['smtp']['username'])
 
-    # Todoist Handling
-    process_todoist_joplin_tag()
 
-    if joplin_configs['auto-sync']:
-        print("Starting Joplin Sync")
-        service.joplin_api.sync()
-except Exception as e:
+def send_error_report() -> None:
     msg = EmailMessage()
     msg['Subject'] = "Automation Hub Error"
     msg.set_content(traceback.format_exc())
     send_mail(msg, mail_configs['smtp']['username'])
-    raise e
 
-print("===============================")
-print("End: ", str(datetime.datetime.now()))
+
+def run_daemon() -> None:
+    interval = daemon_configs.get('interval', DEFAULT_DAEMON_INTERVAL)
+    poll_interval = daemon_configs.get('poll-interval', DEFAULT_DAEMON_POLL_INTERVAL)
+
+    events = queue.Queue()
+    for account in mail_configs['accounts']:
+        for mailbox in get_mailbox_routes(account):
+            MailboxWatcher(account, mailbox, events, poll_interval).start()
+
+    next_run = time.monotonic()
+    while True:
+        timeout = next_run - time.monotonic()
+        if timeout <= 0:
+            try:
+                run_all_jobs()
+            except Exception:
+                traceback.print_exc()
+            next_run = time.monotonic() + interval
+            continue
+
+        try:
+            account, mailbox = events.get(timeout=timeout)
+        except queue.Empty:
+            continue
+
+        print(f"New mail in {account['name']}/{mailbox} at {str(datetime.datetime.now())}")
+        route = get_mailbox_routes(account)[mailbox]
+        unavailable = [breaker.name for breaker in route.services if not breaker.check()]
+        if len(unavailable) > 0:
+            print(f" Leaving the mail for later, {', '.join(unavailable)} unavailable")
+            continue
+
+        try:
+            with MailSession(account) as session:
+                process_mailbox(session, mailbox, route.handler, route.fetch_mode)
+        except Exception:
+            traceback.print_exc()
+            send_error_report()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the automation hub jobs")
+    parser.add_argument('--daemon', action='store_true',
+                        help="keep running, watching the mailboxes with IMAP IDLE and re-running all jobs periodically")
+    args = parser.parse_args()
+
+    try:
+        if args.daemon:
+            run_daemon()
+        else:
+            run_all_jobs()
+    finally:
+        smtp_session.close()
+        service.joplin_api.client.close()
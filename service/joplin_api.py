@@ -1,42 +1,76 @@
 import json
 import os
+import shlex
 import tempfile
-from typing import TypedDict, List, Optional, IO, Any
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import TypedDict, List, Optional, IO, Any, Callable, ContextManager, Iterable, Iterator
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
 
-from configuration import joplin_configs
+from configuration import joplin_configs, html_configs, state_dir
 from constants import PNG_MIME_TYPE, PDF_MIME_TYPE
 from enums import MimeType
+from service.joplin_db import JoplinDatabase
+from utils.attachment import MultipartFileStream, attachment_index, local_file_path
 from utils.file import get_title_from_filename, get_tags_from_filename, get_last_modified_time_from_filename
+from utils.html_markdown import html_to_markdown
 from utils.mail import determine_mime_type
 from utils.ocr import get_image_full_text
 from utils.pdf import get_pdf_full_text
+from utils.state import JsonStateStore
 
 ITEMS_KEY = 'items'
 HAS_MORE_KEY = 'has_more'
+CURSOR_KEY = 'cursor'
+
+DEFAULT_TIMEOUT = 60
+DEFAULT_POOL_SIZE = 4
+# Joplin caps the limit of a listing page at 100 items
+MAX_PAGE_SIZE = 100
+DEFAULT_METADATA_CACHE_TTL = 300
+NOTE_SEPARATOR = '\n\n---\n\n'
+JOPLIN_EVENTS_FILE = 'joplin-events.json'
+DEFAULT_RESOURCE_CACHE_SIZE = 256 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DEFAULT_FULL_SCAN_INTERVAL = 24 * 60 * 60
 
 BASE_URL = f"http://localhost:{joplin_configs['api-port']}"
 
-NOTE_FIELDS = "id,parent_id,title,body,source_url,is_todo,todo_due"
+RESOURCE_FIELDS = "id,title,mime,filename,file_extension,size,updated_time"
+# Listings leave out the body, see LazyJoplinNote
+NOTE_LISTING_FIELDS = "id,parent_id,title,source_url,is_todo,todo_due,updated_time"
+# Fetched to leave changed notes out the way the listings do, deleted_time only exists since Joplin 3.0
+CHANGED_NOTE_STATE_FIELDS = ",is_conflict"
+CHANGED_NOTE_TRASH_FIELDS = ",deleted_time"
 
 NOTES_API_URL = f"{BASE_URL}/notes"
 NOTES_NOTE_API_URL = NOTES_API_URL + "/{note_id}"
 NOTES_TAGS_API_URL = NOTES_NOTE_API_URL + "/tags"
-NOTES_RESOURCES_API_URL = NOTES_NOTE_API_URL + "/resources?fields=id,title,mime,filename,file_extension,size"
+NOTES_RESOURCES_API_URL = NOTES_NOTE_API_URL + "/resources?fields=" + RESOURCE_FIELDS
 
 FOLDERS_API_URL = f"{BASE_URL}/folders"
-FOLDERS_NOTES_API_URL = FOLDERS_API_URL + "/{notebook_id}/notes?fields=" + NOTE_FIELDS
+FOLDERS_NOTES_API_URL = FOLDERS_API_URL + "/{notebook_id}/notes?fields=" + NOTE_LISTING_FIELDS
 
+PING_API_URL = f"{BASE_URL}/ping"
 TAGS_API_URL = f"{BASE_URL}/tags"
 TAG_API_URL = TAGS_API_URL + "/{tag_id}"
-TAG_NOTE_API_URL = TAG_API_URL + "/notes?fields=" + NOTE_FIELDS
+TAG_NOTE_API_URL = TAG_API_URL + "/notes?fields=" + NOTE_LISTING_FIELDS
+TAG_NOTE_IDS_API_URL = TAG_API_URL + "/notes?fields=id"
 TAG_REMOVE_FROM_NOTE_API_URL = TAG_API_URL + "/notes/{note_id}"
 
 RESOURCES_API_URL = f"{BASE_URL}/resources"
 RESOURCES_RESOURCE_API_URL = RESOURCES_API_URL + "/{resource_id}"
 RESOURCES_RESOURCE_FILE_API_URL = RESOURCES_RESOURCE_API_URL + "/file"
 
+EVENTS_API_URL = f"{BASE_URL}/events"
+
 
 # Types
 # note 	1
@@ -55,6 +89,14 @@ RESOURCES_RESOURCE_FILE_API_URL = RESOURCES_RESOURCE_API_URL + "/file"
 # migration 	14
 # smart_filter 	15
 # command 	16
+NOTE_ITEM_TYPE = 1
+
+# Event types
+# created 	1
+# updated 	2
+# deleted 	3
+DELETED_EVENT_TYPE = 3
+
 
 class Notebook(TypedDict):
     id: str
@@ -76,6 +118,30 @@ class JoplinNote(TypedDict):
     source_url: str
     is_todo: int
     todo_due: int
+    updated_time: int
+
+
+class LazyJoplinNote(dict):
+    """A note from a listing, which leaves out the body. The body is requested from the API when it is first read."""
+
+    def __missing__(self, key):
+        if key != 'body':
+            raise KeyError(key)
+
+        if database is not None:
+            notes = database.get_notes([self['id']], 'body,updated_time')
+            note = notes[0] if len(notes) > 0 else None
+        else:
+            params = get_default_params()
+            params['fields'] = 'body,updated_time'
+            note = get_item(NOTES_NOTE_API_URL.format(note_id=self['id']), params=params)
+        if note is None:
+            raise KeyError(key)
+        self.update(note)
+        return self['body']
+
+    def get(self, key, default=None):
+        return self[key] if key in self or key == 'body' else default
 
 
 class Resource(TypedDict):
@@ -99,15 +165,100 @@ class Resource(TypedDict):
     master_key_id: str
 
 
+class CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools open their connections through a connection class of its own, which counts them."""
+
+    def __init__(self, **kwargs):
+        self.connection_count = 0
+        self.connection_count_lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        adapter = self
+
+        class CountingHTTPConnection(HTTPConnection):
+            def connect(self) -> None:
+                super().connect()
+                adapter.count_connection()
+
+        class CountingHTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = CountingHTTPConnection
+
+        self.poolmanager.pool_classes_by_scheme = dict(self.poolmanager.pool_classes_by_scheme,
+                                                       http=CountingHTTPConnectionPool)
+
+    def count_connection(self) -> None:
+        with self.connection_count_lock:
+            self.connection_count += 1
+
+
+class JoplinClient:
+    """Keep-alive HTTP client for the Joplin data API.
+
+    All calls go through one pooled requests.Session, so the many small calls made for a single note reuse the
+    connection to the clipper port instead of opening a new one each time. The API token is set once on the session
+    and every request gets a default timeout.
+    """
+
+    def __init__(self, configs: dict):
+        self.timeout = configs.get('timeout', DEFAULT_TIMEOUT)
+        self.adapter = CountingHTTPAdapter(pool_connections=1,
+                                           pool_maxsize=configs.get('pool-size', DEFAULT_POOL_SIZE))
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.params = {'token': configs['api-key']}
+        self.request_count = 0
+        self.lock = threading.Lock()
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        with self.lock:
+            self.request_count += 1
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', url, **kwargs)
+
+    def get_stats(self) -> dict[str, int]:
+        """Requests issued so far, connections opened for them and how many requests went over a reused connection."""
+        with self.lock:
+            connections = self.adapter.connection_count
+            return {'requests': self.request_count, 'connections': connections,
+                    'reused': max(self.request_count - connections, 0)}
+
+    def close(self) -> None:
+        self.session.close()
+
+
+client = JoplinClient(joplin_configs)
+
+
+# Optional read-only access to the Joplin database for bulk listings, writes always use the API
+database = JoplinDatabase(joplin_configs['database']) if joplin_configs.get('database') else None
+
+page_size = min(joplin_configs.get('page-size', MAX_PAGE_SIZE), MAX_PAGE_SIZE)
+prefetch_pages = joplin_configs.get('prefetch-pages', True)
+
+
 def get_default_params():
-    return {'token': joplin_configs['api-key'], 'limit': 100}
+    return {'limit': page_size}
 
 
 def get_item(url, params=None):
     if params is None:
         params = get_default_params()
 
-    response = requests.get(url, params=params)
+    response = client.get(url, params=params)
     if response.status_code == 404:
         return None
     elif response.status_code != requests.codes.ok:
@@ -119,35 +270,56 @@ def get_item(url, params=None):
             return response.content
 
 
-def get_items(url, params=None):
-    if params is None:
-        params = get_default_params()
-
+def get_pages(url, params):
     page = 1
     has_more = True
-    items = []
     while has_more:
         params['page'] = page
         # order_by = updated_time
         # order_dir = ASC
-        response = requests.get(url, params=params)
+        response = client.get(url, params=params)
         if response.status_code != requests.codes.ok:
             raise RuntimeError(
                 f"Received bad status code ({response.status_code} in get response for {response.request}")
 
         json_body = response.json()
         has_more = json_body[HAS_MORE_KEY]
-        items.extend(json_body[ITEMS_KEY])
+        yield json_body[ITEMS_KEY]
         page += 1
 
-    return items
+
+def prefetch(pages: Iterator[list]) -> Iterator[list]:
+    """Requests the next page on a background thread while the caller works through the current one."""
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_page = executor.submit(next, pages, None)
+        while True:
+            page = next_page.result()
+            if page is None:
+                return
+            next_page = executor.submit(next, pages, None)
+            yield page
+
+
+def get_items(url, params=None, prefetch_next_page=False) -> Iterator[dict]:
+    """Iterates over all items of a listing, requesting the pages as they are reached.
+
+    Pages that are never reached are not requested, so callers can stop early. The listing must not be changed
+    (e.g. by deleting listed notes) while it is being iterated, as that shifts the items between the pages.
+    """
+    params = get_default_params() if params is None else dict(params)
+    pages = get_pages(url, params)
+    if prefetch_next_page:
+        pages = prefetch(pages)
+
+    for page in pages:
+        yield from page
 
 
 def put_item(url, payload, params=None):
     if params is None:
         params = get_default_params()
 
-    response = requests.put(url, json=payload, params=params)
+    response = client.put(url, json=payload, params=params)
     if response.status_code != requests.codes.ok:
         raise RuntimeError(f"Received bad status code ({response.status_code} in put response for {response.request}")
     return response.json()
@@ -157,7 +329,7 @@ def post_item(url, payload, params=None):
     if params is None:
         params = get_default_params()
 
-    response = requests.post(url, json=payload, params=params, timeout=60)
+    response = client.post(url, json=payload, params=params)
     if response.status_code != requests.codes.ok:
         raise RuntimeError(f"Received bad status code ({response.status_code} in post response for {response.request}")
     return response.json()
@@ -167,7 +339,7 @@ def delete_item(url: str, payload=None, params: dict = None) -> Any | None:
     if params is None:
         params = get_default_params()
 
-    response = requests.delete(url, json=payload, params=params)
+    response = client.delete(url, json=payload, params=params)
     if response.status_code != requests.codes.ok:
         raise RuntimeError(
             f"Received bad status code ({response.status_code} in delete response for {response.request}")
@@ -178,16 +350,82 @@ def update_item(url, payload, params=None):
     if params is None:
         params = get_default_params()
 
-    response = requests.put(url, json=payload, params=params)
+    response = client.put(url, json=payload, params=params)
     if response.status_code != requests.codes.ok:
         raise RuntimeError(f"Received bad status code ({response.status_code} in get response for {response.request}")
     return response.json()
 
 
+class MetadataCache:
+    """Tags or notebooks, listed once and then kept up to date in place, with an index by lowercase title for find().
+
+    The listing is reloaded after ttl seconds (relevant when running as a daemon) or after invalidate() was called,
+    e.g. because Joplin reported changes that were not made through this module.
+    """
+
+    def __init__(self, list_items: Callable[[], Iterable[dict]], ttl: Optional[float]):
+        self.list_items = list_items
+        self.ttl = ttl
+        self.items: Optional[list[dict]] = None
+        # First item of each lowercase title, titles can repeat e.g. for notebooks under different parents
+        self.index: dict[str, dict] = {}
+        self.loaded_at = 0.0
+        self.lock = threading.RLock()
+
+    def load(self) -> None:
+        with self.lock:
+            if self.items is None or (self.ttl is not None and time.monotonic() - self.loaded_at > self.ttl):
+                self.set_items(list(self.list_items()))
+                self.loaded_at = time.monotonic()
+
+    def set_items(self, items: list[dict]) -> None:
+        self.items = items
+        self.index = {}
+        for item in items:
+            self.index.setdefault(item['title'].lower(), item)
+
+    def values(self) -> list[dict]:
+        with self.lock:
+            self.load()
+            return list(self.items)
+
+    def find(self, title: str) -> Optional[dict]:
+        with self.lock:
+            self.load()
+            return self.index.get(title.lower())
+
+    def add(self, item: dict) -> None:
+        with self.lock:
+            if self.items is not None:
+                self.items.append(item)
+                self.index.setdefault(item['title'].lower(), item)
+
+    def remove(self, item: dict) -> None:
+        with self.lock:
+            if self.items is not None:
+                self.set_items([i for i in self.items if i['id'] != item['id']])
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.items = None
+
+
+metadata_cache_ttl = joplin_configs.get('metadata-cache-ttl', DEFAULT_METADATA_CACHE_TTL)
+tag_cache = MetadataCache(lambda: database.get_tags() if database else get_items(TAGS_API_URL), metadata_cache_ttl)
+notebook_cache = MetadataCache(lambda: database.get_folders() if database else get_items(FOLDERS_API_URL),
+                               metadata_cache_ttl)
+
+
+def invalidate_metadata_cache() -> None:
+    tag_cache.invalidate()
+    notebook_cache.invalidate()
+
+
 def create_notebook(notebook_name):
     print(f"Creating notebook {notebook_name}")
     body = {'title': notebook_name}
     notebook = post_item(FOLDERS_API_URL, body)
+    notebook_cache.add(notebook)
     return notebook
 
 
@@ -228,17 +466,18 @@ def get_inactive_projects() -> List[Notebook]:
 
 
 def get_tags() -> List[Tag]:
-    tags = get_items(TAGS_API_URL)
-    return tags
+    return tag_cache.values()
 
 
 def create_tag(tag_name: str) -> Tag:
     tag = post_item(TAGS_API_URL, {'title': tag_name})
+    tag_cache.add(tag)
     return tag
 
 
 def delete_tag(tag: Tag):
     out = delete_item(TAG_API_URL.format(tag_id=tag['id']))
+    tag_cache.remove(tag)
     return out
 
 
@@ -250,10 +489,8 @@ def add_note_tag(note: JoplinNote, tag: Tag) -> None:
 
 def add_note_tags(note: JoplinNote, tags: List[str]) -> None:
     if len(tags) > 0:
-        existing_tags = get_tags()
         for tag in tags:
-            tag_lower = tag.lower()
-            existing_tag = next((t for t in existing_tags if t['title'].lower() == tag_lower), None)
+            existing_tag = tag_cache.find(tag)
             if existing_tag is None:
                 print(f"Tag {tag} does not exist, creating....")
                 tag_id = create_tag(tag)['id']
@@ -266,12 +503,48 @@ def add_note_tags(note: JoplinNote, tags: List[str]) -> None:
 
 def remove_note_tag(note: JoplinNote, tag: Tag) -> None:
     delete_item(TAG_REMOVE_FROM_NOTE_API_URL.format(tag_id=tag['id'], note_id=note['id']))
+    if tag['title'].lower() == joplin_configs.get('processed-tag', '').lower():
+        processed_notes.discard(note)
 
 
-def add_generic_attachment(note: JoplinNote, file_name: str, file_like: IO) -> Resource:
-    resource = add_resource(file_name, file_like)
-    append_to_note(note, f"[{file_name}](:/{resource['id']})")
-    return resource
+def resource_exists(resource_id: str) -> bool:
+    params = get_default_params()
+    params['fields'] = 'id'
+    return get_item(RESOURCES_RESOURCE_API_URL.format(resource_id=resource_id), params=params) is not None
+
+
+def get_indexed_resource_ids(entry: dict) -> List[str]:
+    return [entry[key] for key in ('resource', 'thumbnail') if entry.get(key)]
+
+
+def find_indexed_attachment(kind: str, digest: Optional[str]) -> Optional[dict]:
+    """The resources created earlier for an attachment with the same content, if they still exist."""
+    namespace = f"joplin:{kind}"
+    entry = attachment_index.get(namespace, digest)
+    if entry is None:
+        return None
+
+    if not all(resource_exists(resource_id) for resource_id in get_indexed_resource_ids(entry)):
+        attachment_index.drop(namespace, digest)
+        return None
+
+    print(f"   Linking existing resource {entry['resource']}")
+    return entry
+
+
+def verify_attachment_index() -> None:
+    attachment_index.verify('joplin', lambda digest, entry: all(resource_exists(resource_id)
+                                                                for resource_id in get_indexed_resource_ids(entry)))
+
+
+def add_generic_attachment(note: JoplinNote, file_name: str, file_like: IO) -> None:
+    digest = attachment_index.get_digest(file_like)
+    entry = find_indexed_attachment('file', digest)
+    if entry is None:
+        entry = {'resource': add_resource(file_name, file_like)['id']}
+        attachment_index.put('joplin:file', digest, entry)
+
+    append_to_note(note, f"[{file_name}](:/{entry['resource']})")
 
 
 def add_resource(file_name: str, file_like: IO, mime_type: str = None) -> Resource:
@@ -281,8 +554,9 @@ def add_resource(file_name: str, file_like: IO, mime_type: str = None) -> Resour
     if mime_type:
         payload['mime'] = mime_type
 
-    data = [('props', json.dumps(payload))]
-    response = requests.post(RESOURCES_API_URL, data=data, files={'data': file_like}, params=get_default_params())
+    stream = MultipartFileStream({'props': json.dumps(payload)}, 'data', file_name, file_like)
+    response = client.post(RESOURCES_API_URL, data=stream, headers={'Content-Type': stream.content_type},
+                           params=get_default_params())
     if response.status_code != requests.codes.ok:
         raise RuntimeError(f"Received bad status code ({response.status_code} in get response for {response.request}")
     resource = response.json()
@@ -293,32 +567,29 @@ def delete_note(note):
     delete_item(NOTES_NOTE_API_URL.format(note_id=note['id']))
 
 
+def convert_html_with_joplin(html: str) -> str:
+    # Create temporary note to convert html to md exactly like Joplin does
+    tmp_note = create_new_note("Temp", html, is_html=True)
+    text = tmp_note['body']
+    delete_note(tmp_note)
+    return text
+
+
 def attach_text_to_note(note: JoplinNote, file_like: IO, is_html: bool = False) -> None:
     text = file_like.read()
     if is_html:
-        # Create temporary note to convert html to md consistently
-        tmp_note = create_new_note("Temp", text, is_html=is_html)
-        text = tmp_note['body']
-        delete_note(tmp_note)
+        if html_configs.get('engine', 'local') == 'joplin':
+            text = convert_html_with_joplin(text)
+        else:
+            text = html_to_markdown(text)
 
     append_to_note(note, text)
 
 
-def get_note_body(note: JoplinNote) -> Optional[str]:
-    params = get_default_params()
-    params['fields'] = 'body'
-    note = get_item(NOTES_NOTE_API_URL.format(note_id=note['id']), params=params)
-    return note['body'] if note and 'body' in note else None
-
-
 def add_pdf_thumbnail(pdf_file_like: IO) -> Optional[Resource]:
-    with tempfile.TemporaryDirectory() as tmpdir:
-        with open(f"{tmpdir}/tmp.pdf", mode="wb") as f:
-            f.write(pdf_file_like.read())
-
-        cmd = f"pdftoppm -scale-to 300 -singlefile -png '{tmpdir}/tmp.pdf' '{tmpdir}/thumb'"
+    with tempfile.TemporaryDirectory() as tmpdir, local_file_path(pdf_file_like) as pdf_file_name:
+        cmd = f"pdftoppm -scale-to 300 -singlefile -png {shlex.quote(pdf_file_name)} '{tmpdir}/thumb'"
         ret = os.system(cmd)
-        os.remove(f"{tmpdir}/tmp.pdf")
         if ret != 0:
             print(f"Error executing command '{cmd}'")
             return None
@@ -331,8 +602,98 @@ def add_pdf_thumbnail(pdf_file_like: IO) -> Optional[Resource]:
             return resource
 
 
-def set_note_body(note: JoplinNote, body: str) -> None:
-    update_item(NOTES_NOTE_API_URL.format(note_id=note['id']), {'body': body})
+class NoteEditor:
+    """Appends to the body of one note, collected in memory and written back with a single PUT.
+
+    Before writing, the updated_time of the note is compared with the one of the loaded body. If the note was changed
+    in the meantime, the body is reloaded and the appends are applied again on top of it.
+    """
+
+    def __init__(self, note: JoplinNote):
+        self.note = note
+        self.body: Optional[str] = None
+        self.updated_time: Optional[int] = None
+        self.appends: list[str] = []
+        self.lock = threading.RLock()
+
+    def get_note_fields(self, fields: str) -> dict:
+        params = get_default_params()
+        params['fields'] = fields
+        note = get_item(NOTES_NOTE_API_URL.format(note_id=self.note['id']), params=params)
+        if note is None:
+            raise RuntimeError(f"Note '{self.note.get('title', self.note['id'])}' no longer exists")
+        return note
+
+    def load(self) -> None:
+        if 'body' in self.note and 'updated_time' in self.note:
+            # Notes returned by create_new_note already carry their current body
+            note = self.note
+        else:
+            note = self.get_note_fields('body,updated_time')
+        self.body = note['body'] or ''
+        self.updated_time = note['updated_time']
+
+    def reload(self) -> None:
+        note = self.get_note_fields('body,updated_time')
+        self.body = note['body'] or ''
+        self.updated_time = note['updated_time']
+
+    def has_changed(self) -> bool:
+        return self.get_note_fields('updated_time')['updated_time'] != self.updated_time
+
+    def append(self, text: str) -> None:
+        with self.lock:
+            self.appends.append(text)
+
+    def commit(self) -> None:
+        with self.lock:
+            if len(self.appends) == 0:
+                return
+
+            if self.body is None:
+                self.reload()
+            elif self.has_changed():
+                print(f"   Note '{self.note.get('title', self.note['id'])}' changed while editing, reloading it")
+                self.reload()
+
+            body = self.body
+            for text in self.appends:
+                if len(body.strip()) > 0:
+                    body += NOTE_SEPARATOR
+                body += text
+            note = update_item(NOTES_NOTE_API_URL.format(note_id=self.note['id']), {'body': body})
+            self.body = body
+            self.updated_time = note.get('updated_time') if isinstance(note, dict) else None
+            self.appends = []
+
+
+open_note_editors: dict[str, NoteEditor] = {}
+open_note_editors_lock = threading.Lock()
+
+
+@contextmanager
+def edit_note(note: JoplinNote) -> Iterator[NoteEditor]:
+    """Buffers every append_to_note on the note while the context is open and writes them out once when it exits
+    without an error. Nested contexts on the same note share the editor of the outermost one.
+    """
+    with open_note_editors_lock:
+        editor = open_note_editors.get(note['id'])
+        owner = editor is None
+        if owner:
+            editor = NoteEditor(note)
+            open_note_editors[note['id']] = editor
+
+    if not owner:
+        yield editor
+        return
+
+    try:
+        editor.load()
+        yield editor
+        editor.commit()
+    finally:
+        with open_note_editors_lock:
+            del open_note_editors[note['id']]
 
 
 def append_to_note(note: JoplinNote, text: str) -> None:
@@ -345,31 +706,46 @@ def append_to_note(note: JoplinNote, text: str) -> None:
     if len(text.strip()) == 0:
         return
 
-    orig_body = get_note_body(note)
-    if orig_body is not None and len(orig_body.strip()) > 0:
-        orig_body += '\n\n---\n\n'
-    orig_body += text
-    set_note_body(note, orig_body)
+    editor = open_note_editors.get(note['id'])
+    if editor is not None:
+        editor.append(text)
+    else:
+        editor = NoteEditor(note)
+        editor.append(text)
+        editor.commit()
 
 
 def add_pdf_attachment(note: JoplinNote, file_name: str, file_like: IO) -> None:
-    thumbnail = add_pdf_thumbnail(file_like)
-    file_like.seek(0)
-    resource = add_resource(file_name, file_like, PDF_MIME_TYPE)
-    file_like.seek(0)
-    pdf_text = get_pdf_full_text(file_like)
-
-    if thumbnail is None:
-        append_to_note(note, f"[{file_name}](:/{resource['id']})\n\n{pdf_text}")
+    digest = attachment_index.get_digest(file_like)
+    entry = find_indexed_attachment('pdf', digest)
+    if entry is None:
+        thumbnail = add_pdf_thumbnail(file_like)
+        file_like.seek(0)
+        resource = add_resource(file_name, file_like, PDF_MIME_TYPE)
+        entry = {'resource': resource['id'], 'thumbnail': thumbnail['id'] if thumbnail else None, 'text': None}
+    if entry['text'] is None:
+        file_like.seek(0)
+        entry['text'] = get_pdf_full_text(file_like)
+        attachment_index.put('joplin:pdf', digest, dict(entry))
+    pdf_text = entry['text']
+
+    if entry['thumbnail'] is None:
+        append_to_note(note, f"[{file_name}](:/{entry['resource']})\n\n{pdf_text}")
     else:
-        append_to_note(note, f"[![{file_name}](:/{thumbnail['id']})](:/{resource['id']})\n\n{pdf_text}")
+        append_to_note(note, f"[![{file_name}](:/{entry['thumbnail']})](:/{entry['resource']})\n\n{pdf_text}")
 
 
 def add_img_attachment(note: JoplinNote, file_name: str, file_like: IO) -> None:
-    resource = add_resource(file_name, file_like)
-    body = f"![{file_name}](:/{resource['id']})"
-    file_like.seek(0)
-    img_text = get_image_full_text(file_like)
+    digest = attachment_index.get_digest(file_like)
+    entry = find_indexed_attachment('img', digest)
+    if entry is None:
+        entry = {'resource': add_resource(file_name, file_like)['id'], 'text': None}
+    body = f"![{file_name}](:/{entry['resource']})"
+    if entry['text'] is None:
+        file_like.seek(0)
+        entry['text'] = get_image_full_text(file_like)
+        attachment_index.put('joplin:img', digest, dict(entry))
+    img_text = entry['text']
     if len(img_text.strip()) != 0:
         body += f"\n\n{img_text}"
     append_to_note(note, body)
@@ -391,8 +767,7 @@ def add_attachment(note: JoplinNote, file_name: str, file_like: IO, mime_type: M
 
 
 def get_notebooks():
-    folders = get_items(FOLDERS_API_URL)
-    return folders
+    return notebook_cache.values()
 
 
 def get_default_notebook():
@@ -408,9 +783,7 @@ def get_notebook(nb_name, default_on_missing=True, auto_create=joplin_configs['a
     if not nb_name or not nb_name.strip():
         return get_default_notebook() if default_on_missing else None
 
-    nb_name_lower = nb_name.lower()
-    notebooks = get_notebooks()
-    notebook = next((nb for nb in notebooks if nb['title'].lower() == nb_name_lower), None)
+    notebook = notebook_cache.find(nb_name)
     if notebook is None:
         if auto_create:
             notebook = create_notebook(nb_name)
@@ -426,9 +799,7 @@ def get_tag(tag_name, auto_create=joplin_configs['auto-create-tag']):
     if not tag_name or not tag_name.strip():
         return None
 
-    tag_name_lower = tag_name.lower()
-    tags = get_tags()
-    tag = next((tag for tag in tags if tag['title'].lower() == tag_name_lower), None)
+    tag = tag_cache.find(tag_name)
     if tag is None:
         if auto_create:
             tag = create_tag(tag_name)
@@ -455,37 +826,59 @@ def add_new_note_from_file(file):
     import mimetypes
     content_type = mimetypes.MimeTypes().guess_type(file)[0]
     file_type = determine_mime_type(file_name, content_type)
-    with open(file, "rb") as f:
+    with open(file, "rb") as f, edit_note(note):
         add_attachment(note, file_name, f, file_type)
 
 
+def ping(timeout: float) -> None:
+    """Raises when the Joplin data API doesn't answer, e.g. because the app isn't running."""
+    try:
+        response = client.get(PING_API_URL, timeout=timeout)
+    except requests.RequestException as exc:
+        raise RuntimeError(f"Joplin API not reachable at {BASE_URL}: {exc}") from exc
+    if response.status_code != requests.codes.ok:
+        raise RuntimeError(f"Received bad status code ({response.status_code}) from the Joplin API ping")
+
+
 def sync():
     pass  # TODO
 
 
-def get_notes_in_notebook(notebook: Notebook) -> List[JoplinNote]:
+def get_notes_in_notebook(notebook: Notebook) -> Iterator[JoplinNote]:
     if not notebook:
-        return []
+        return iter([])
 
-    notes = get_items(FOLDERS_NOTES_API_URL.format(notebook_id=notebook['id']))
-    return notes
+    if database is not None:
+        notes = database.get_notes_in_folder(notebook['id'], NOTE_LISTING_FIELDS)
+    else:
+        notes = get_items(FOLDERS_NOTES_API_URL.format(notebook_id=notebook['id']), prefetch_next_page=prefetch_pages)
+    return (LazyJoplinNote(note) for note in notes)
 
 
-def get_notes_with_tag(tag: Tag) -> List[JoplinNote]:
+def get_notes_with_tag(tag: Tag) -> Iterator[JoplinNote]:
     if not tag:
-        return []
+        return iter([])
 
-    notes = get_items(TAG_NOTE_API_URL.format(tag_id=tag['id']))
-    return notes
+    if database is not None:
+        notes = database.get_notes_with_tag(tag['id'], NOTE_LISTING_FIELDS)
+    else:
+        notes = get_items(TAG_NOTE_API_URL.format(tag_id=tag['id']), prefetch_next_page=prefetch_pages)
+    return (LazyJoplinNote(note) for note in notes)
 
 
 def get_note_tags(note: JoplinNote) -> List[Tag]:
-    tags = get_items(NOTES_TAGS_API_URL.format(note_id=note['id']))
+    if database is not None:
+        return database.get_note_tags(note['id'])
+
+    tags = list(get_items(NOTES_TAGS_API_URL.format(note_id=note['id'])))
     return tags
 
 
 def get_note_resources(note: JoplinNote) -> List[Resource]:
-    resources = get_items(NOTES_RESOURCES_API_URL.format(note_id=note['id']))
+    if database is not None:
+        return database.get_note_resources(note['id'])
+
+    resources = list(get_items(NOTES_RESOURCES_API_URL.format(note_id=note['id'])))
     return resources
 
 
@@ -494,8 +887,127 @@ def get_resource(resource_id: str) -> Resource:
     return resource
 
 
-def get_resource_file(resource_id):
-    return get_item(RESOURCES_RESOURCE_FILE_API_URL.format(resource_id=resource_id))
+def download_resource_file(resource_id: str, file_like: IO[bytes]) -> None:
+    response = client.get(RESOURCES_RESOURCE_FILE_API_URL.format(resource_id=resource_id), stream=True)
+    with response:
+        if response.status_code != requests.codes.ok:
+            raise RuntimeError(
+                f"Received bad status code ({response.status_code} in get response for {response.request}")
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            file_like.write(chunk)
+
+
+class ResourceFileCache:
+    """Resource files downloaded from the API, kept on disk within a byte budget and evicted least recently used first.
+
+    Files are keyed by resource id and updated_time, so a changed resource is downloaded again and its old version
+    ages out. A budget of 0 disables the cache, files are then downloaded to a temporary file on every use.
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        # File name -> size, least recently used first
+        self.files: Optional[OrderedDict[str, int]] = None
+        self.lock = threading.Lock()
+
+    def load_index(self) -> None:
+        if self.files is not None:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp'):
+                # Left over by an interrupted download
+                os.remove(entry.path)
+            elif entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        self.files = OrderedDict((name, size) for _, name, size in sorted(entries))
+
+    def evict(self, keep: str) -> None:
+        total = sum(self.files.values())
+        for name in list(self.files):
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            total -= self.files.pop(name)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def open_cached(self, name: str) -> Optional[IO[bytes]]:
+        with self.lock:
+            self.load_index()
+            if name not in self.files:
+                return None
+
+            path = os.path.join(self.directory, name)
+            try:
+                # Opened under the lock, so a concurrent eviction can only unlink the file once it is open
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                del self.files[name]
+                return None
+            os.utime(path)
+            self.files.move_to_end(name)
+            return f
+
+    @contextmanager
+    def open(self, resource_id: str, updated_time: int) -> Iterator[IO[bytes]]:
+        if self.max_size <= 0:
+            with tempfile.TemporaryFile() as f:
+                download_resource_file(resource_id, f)
+                f.seek(0)
+                yield f
+            return
+
+        name = f"{resource_id}-{updated_time}"
+        f = self.open_cached(name)
+        if f is None:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as tmp_file:
+                    download_resource_file(resource_id, tmp_file)
+                path = os.path.join(self.directory, name)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+            with self.lock:
+                f = open(path, 'rb')
+                self.files[name] = os.path.getsize(path)
+                self.files.move_to_end(name)
+                self.evict(keep=name)
+
+        with f:
+            yield f
+
+
+resource_cache_dir = joplin_configs.get('resource-cache-dir', os.path.join(state_dir, 'joplin-resources'))
+resource_cache = ResourceFileCache(resource_cache_dir,
+                                   joplin_configs.get('resource-cache-size', DEFAULT_RESOURCE_CACHE_SIZE))
+
+
+def open_resource(resource: Resource) -> ContextManager[IO[bytes]]:
+    """Opens the file of a resource for reading, from the resource cache when possible."""
+    if 'updated_time' not in resource:
+        resource = get_resource(resource['id'])
+    return resource_cache.open(resource['id'], resource['updated_time'])
+
+
+def get_resource_file(resource_id: str) -> Optional[bytes]:
+    resource = get_resource(resource_id)
+    if resource is None:
+        return None
+
+    with open_resource(resource) as f:
+        return f.read()
 
 
 def move_note(note, nb_name):
@@ -528,12 +1040,202 @@ def handle_processed_note(note):
         delete_note(note)
     elif 'processed-tag' in joplin_configs and len(joplin_configs['processed-tag'].strip()) > 0:
         print(" Tagging note as processed")
-        tag_note(note, joplin_configs['processed-tag'])
+        if tag_note(note, joplin_configs['processed-tag']) is not None:
+            processed_notes.add(note)
     else:
         raise RuntimeError("Missing Joplin config processed-tag and delete-processed is missing or false")
 
 
+class ProcessedNoteIndex:
+    """Ids of the notes carrying the processed tag.
+
+    They are listed once per run with a single query on the tag, instead of listing the tags of every candidate note,
+    and kept up to date locally as notes get tagged.
+    """
+
+    def __init__(self):
+        self.note_ids: Optional[set[str]] = None
+        self.lock = threading.RLock()
+
+    def get_note_ids(self) -> set[str]:
+        with self.lock:
+            if self.note_ids is None:
+                tag = get_tag(joplin_configs['processed-tag'], auto_create=False)
+                if not tag:
+                    notes = []
+                elif database is not None:
+                    notes = database.get_notes_with_tag(tag['id'], 'id')
+                else:
+                    notes = get_items(TAG_NOTE_IDS_API_URL.format(tag_id=tag['id']))
+                self.note_ids = {note['id'] for note in notes}
+            return self.note_ids
+
+    def contains(self, note: JoplinNote) -> bool:
+        return note['id'] in self.get_note_ids()
+
+    def add(self, note: JoplinNote) -> None:
+        with self.lock:
+            if self.note_ids is not None:
+                self.note_ids.add(note['id'])
+
+    def discard(self, note: JoplinNote) -> None:
+        with self.lock:
+            if self.note_ids is not None:
+                self.note_ids.discard(note['id'])
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.note_ids = None
+
+
+processed_notes = ProcessedNoteIndex()
+
+
 def is_processed(note):
-    processed_tag_name = joplin_configs['processed-tag'].lower()
-    processed_tag = next((tag for tag in get_note_tags(note) if tag['title'].lower() == processed_tag_name), None)
-    return True if processed_tag else False
+    return processed_notes.contains(note)
+
+
+# Whether the Joplin API knows the trash (deleted_time, Joplin 3.0 and later), probed once by is_trash_supported()
+trash_supported: Optional[bool] = None
+trash_supported_lock = threading.Lock()
+
+
+def is_trash_supported() -> bool:
+    global trash_supported
+    with trash_supported_lock:
+        if trash_supported is None:
+            params = {'fields': 'id,deleted_time', 'limit': 1}
+            response = client.get(NOTES_API_URL, params=params)
+            if response.status_code == requests.codes.ok:
+                trash_supported = True
+            elif 'deleted_time' in response.text:
+                # Joplin before 3.0 fails the query on the unknown column, any other error is raised
+                trash_supported = False
+            else:
+                raise RuntimeError(
+                    f"Received bad status code ({response.status_code} in get response for {response.request}")
+        return trash_supported
+
+
+class JoplinChanges:
+    """Ids of the notes changed since the previous run."""
+
+    def __init__(self):
+        self.note_ids: set[str] = set()
+        self.notes: Optional[List[JoplinNote]] = None
+
+    def get_notes(self) -> List[JoplinNote]:
+        """The changed notes, leaving out conflicts and trashed notes like the note listings do."""
+        if self.notes is None:
+            if database is not None:
+                notes = database.get_notes(sorted(self.note_ids), NOTE_LISTING_FIELDS)
+            else:
+                notes = (get_changed_note(note_id) for note_id in sorted(self.note_ids))
+            self.notes = [LazyJoplinNote(note) for note in notes if note is not None]
+        return self.notes
+
+
+def get_changed_note(note_id: str) -> Optional[JoplinNote]:
+    params = get_default_params()
+    params['fields'] = NOTE_LISTING_FIELDS + CHANGED_NOTE_STATE_FIELDS
+    if is_trash_supported():
+        params['fields'] += CHANGED_NOTE_TRASH_FIELDS
+    note = get_item(NOTES_NOTE_API_URL.format(note_id=note_id), params=params)
+    if note is None or note.pop('is_conflict', 0) or note.pop('deleted_time', 0):
+        return None
+    return note
+
+
+class JoplinChangeFeed:
+    """Changes since the previous run, read from the /events endpoint of the Joplin API.
+
+    The cursor of the events is kept in a state file and only advanced by commit() once a run succeeded, so the changes
+    seen by a failed run are offered again. Joplin only reports note events, tagging a note without editing it isn't
+    one, so the feed only narrows down notebook triggers. A full scan runs at least every full-scan-interval seconds.
+    """
+
+    def __init__(self, configs: dict):
+        self.enabled = configs.get('change-feed', False)
+        self.full_scan_interval = configs.get('full-scan-interval', DEFAULT_FULL_SCAN_INTERVAL)
+        self.store: Optional[JsonStateStore] = None
+        self.changes: Optional[JoplinChanges] = None
+        self.next_cursor: Optional[str] = None
+        self.full_scan = False
+
+    def start_run(self) -> None:
+        self.changes = None
+        self.next_cursor = None
+        self.full_scan = False
+        if not self.enabled:
+            return
+
+        if self.store is None:
+            self.store = JsonStateStore(JOPLIN_EVENTS_FILE)
+
+        cursor = self.store.get('cursor')
+        if cursor is None or time.time() - self.store.get('last-full-scan', 0) > self.full_scan_interval:
+            # Without a cursor the API only returns the current one
+            events = get_item(EVENTS_API_URL)
+            if events is None:
+                print("Warning: the Joplin API has no /events endpoint, disabling the change feed")
+                self.enabled = False
+                return
+
+            self.next_cursor = events[CURSOR_KEY]
+            self.full_scan = True
+            return
+
+        changes = JoplinChanges()
+        has_more = True
+        while has_more:
+            params = get_default_params()
+            params['cursor'] = cursor
+            events = get_item(EVENTS_API_URL, params=params)
+            if events is None:
+                print("Warning: the Joplin change feed cursor is unknown, scanning everything")
+                self.store.delete('cursor')
+                self.start_run()
+                return
+
+            for event in events[ITEMS_KEY]:
+                if event['item_type'] == NOTE_ITEM_TYPE and event['type'] != DELETED_EVENT_TYPE:
+                    changes.note_ids.add(event['item_id'])
+            cursor = events[CURSOR_KEY]
+            has_more = events[HAS_MORE_KEY]
+
+        print(f"Joplin change feed: {len(changes.note_ids)} changed notes")
+        self.changes = changes
+        self.next_cursor = cursor
+
+    def get_changes(self) -> Optional[JoplinChanges]:
+        """The changes of the current run, or None when the run has to scan everything."""
+        return self.changes
+
+    def commit(self) -> None:
+        if not self.enabled or self.next_cursor is None:
+            return
+
+        self.store.set('cursor', self.next_cursor)
+        if self.full_scan:
+            self.store.set('last-full-scan', time.time())
+        self.store.save()
+
+
+change_feed = JoplinChangeFeed(joplin_configs)
+
+
+def get_candidate_notes_in_notebook(notebook: Notebook) -> Iterable[JoplinNote]:
+    """Notes of the notebook that may need processing: all of them, or only the changed ones with the change feed."""
+    changes = change_feed.get_changes()
+    if changes is None:
+        return get_notes_in_notebook(notebook)
+    if not notebook:
+        return []
+
+    return [note for note in changes.get_notes() if note['parent_id'] == notebook['id']]
+
+
+def get_candidate_notes_with_tag(tag: Tag) -> Iterable[JoplinNote]:
+    """Notes with the tag that may need processing. Always the tag listing: tagging a note creates no note event and
+    the listing comes without note bodies anyway."""
+    return get_notes_with_tag(tag)
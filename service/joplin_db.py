@@ -0,0 +1,91 @@
+import os
+import sqlite3
+import threading
+import urllib.parse
+from typing import Iterable, List
+
+FOLDER_FIELDS = "id,parent_id,title"
+TAG_FIELDS = "id,parent_id,title"
+RESOURCE_FIELDS = "id,title,mime,filename,file_extension,size,updated_time"
+
+
+class JoplinDatabase:
+    """Read-only access to the database of a Joplin profile (database.sqlite) for bulk listings.
+
+    The file is opened with mode=ro, so the Joplin app stays the only writer and reads see its committed WAL
+    transactions. All writes keep going through the REST API. Queries return dicts with the same fields as the
+    corresponding API listings, including the API's exclusion of conflicts and trashed items.
+    """
+
+    def __init__(self, path: str):
+        self.uri = f"file:{urllib.parse.quote(os.path.expanduser(path))}?mode=ro"
+        self.local = threading.local()
+        self.columns: dict[str, set[str]] = {}
+        self.lock = threading.Lock()
+
+    def get_connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.uri, uri=True)
+            connection.row_factory = sqlite3.Row
+            self.local.connection = connection
+        return connection
+
+    def query(self, sql: str, params: Iterable = ()) -> List[dict]:
+        return [dict(row) for row in self.get_connection().execute(sql, tuple(params))]
+
+    def has_column(self, table: str, column: str) -> bool:
+        with self.lock:
+            if table not in self.columns:
+                rows = self.get_connection().execute(f"PRAGMA table_info({table})")
+                self.columns[table] = {row['name'] for row in rows}
+            return column in self.columns[table]
+
+    def visible(self, table: str, alias: str) -> str:
+        # Joplin 3 moves deleted items to the trash by setting deleted_time, the API leaves them out
+        return f" AND {alias}.deleted_time = 0" if self.has_column(table, 'deleted_time') else ""
+
+    @staticmethod
+    def select(alias: str, fields: str) -> str:
+        return ", ".join(f"{alias}.{field}" for field in fields.split(','))
+
+    def get_folders(self) -> List[dict]:
+        return self.query(f"SELECT {self.select('f', FOLDER_FIELDS)} FROM folders f WHERE 1 = 1"
+                          f"{self.visible('folders', 'f')}")
+
+    def get_tags(self) -> List[dict]:
+        return self.query(f"SELECT {self.select('t', TAG_FIELDS)} FROM tags t WHERE 1 = 1{self.visible('tags', 't')}")
+
+    def get_notes(self, note_ids: Iterable[str], fields: str) -> List[dict]:
+        note_ids = list(note_ids)
+        if len(note_ids) == 0:
+            return []
+
+        return self.query(f"SELECT {self.select('n', fields)} FROM notes n "
+                          f"WHERE n.id IN ({', '.join('?' * len(note_ids))}) AND n.is_conflict = 0"
+                          f"{self.visible('notes', 'n')}", note_ids)
+
+    def get_notes_in_folder(self, folder_id: str, fields: str) -> List[dict]:
+        return self.query(f"SELECT {self.select('n', fields)} FROM notes n "
+                          f"WHERE n.parent_id = ? AND n.is_conflict = 0{self.visible('notes', 'n')}", [folder_id])
+
+    def get_notes_with_tag(self, tag_id: str, fields: str) -> List[dict]:
+        return self.query(f"SELECT {self.select('n', fields)} FROM note_tags nt JOIN notes n ON n.id = nt.note_id "
+                          f"WHERE nt.tag_id = ? AND n.is_conflict = 0{self.visible('notes', 'n')}", [tag_id])
+
+    def get_note_tags(self, note_id: str) -> List[dict]:
+        return self.query(f"SELECT {self.select('t', TAG_FIELDS)} FROM note_tags nt JOIN tags t ON t.id = nt.tag_id "
+                          f"WHERE nt.note_id = ?{self.visible('tags', 't')}", [note_id])
+
+    def get_note_resources(self, note_id: str) -> List[dict]:
+        # note_resources is maintained by Joplin's resource indexer from the links in the note body
+        return self.query(f"SELECT {self.select('r', RESOURCE_FIELDS)} FROM note_resources nr "
+                          f"JOIN resources r ON r.id = nr.resource_id "
+                          f"WHERE nr.note_id = ? AND nr.is_associated = 1", [note_id])
+
+    def close(self) -> None:
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
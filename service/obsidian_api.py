@@ -1,20 +1,19 @@
 import os.path
-from io import BytesIO
+import shutil
+from io import TextIOBase
 from typing import Optional, List, IO, BinaryIO
 
-import html2text
-
 from configuration import obsidian_configs
 from enums import MimeType
+from utils.attachment import attachment_index, hash_file
+from utils.html_markdown import html_to_markdown
 from utils.ocr import get_image_full_text
 from utils.pdf import get_pdf_full_text
 
-H2T = html2text.HTML2Text()
-
 
 def create_new_note(name: str, body: str, path: Optional[str] = None, is_html: bool = False, tags: Optional[List[str]] = None) -> (str, str):
     if is_html:
-        body = H2T.handle(body)
+        body = html_to_markdown(body)
 
     if path is None:
         path = get_default_notebook()
@@ -94,16 +93,50 @@ def create_new_note(name: str, body: str, path: Optional[str] = None, is_html: b
 
 
 def add_generic_attachment(path: str, filename: str, attachment_name: str, file_like: IO):
-    add_resource(path, attachment_name, file_like)
-    append_to_note(path, filename, f"![[{attachment_name}]]")
+    digest = attachment_index.get_digest(file_like)
+    entry = find_indexed_attachment('file', digest)
+    if entry is None:
+        add_resource(path, attachment_name, file_like)
+        entry = {'path': path, 'name': attachment_name}
+        attachment_index.put('obsidian:file', digest, entry)
+    append_to_note(path, filename, f"![[{entry['name']}]]")
 
 
 def add_resource(path: str, file_name: str, file_like: IO):
     vault_path = to_vault_path(path, file_name)
 
-    mode = "wb" if isinstance(file_like, BytesIO) else "w"
+    mode = "w" if isinstance(file_like, TextIOBase) else "wb"
     with open(vault_path, mode) as file:
-        file.write(file_like.read())
+        shutil.copyfileobj(file_like, file)
+
+
+def find_indexed_attachment(kind: str, digest: Optional[str]) -> Optional[dict]:
+    """The vault file stored earlier for an attachment with the same content, if it still holds that content."""
+    namespace = f"obsidian:{kind}"
+    entry = attachment_index.get(namespace, digest)
+    if entry is None:
+        return None
+
+    if not is_indexed_file(digest, entry):
+        attachment_index.drop(namespace, digest)
+        return None
+
+    print(f"   Linking existing attachment {entry['path']}/{entry['name']}")
+    return entry
+
+
+def is_indexed_file(digest: str, entry: dict) -> bool:
+    vault_path = to_vault_path(entry['path'], entry['name'])
+    if not os.path.isfile(vault_path):
+        return False
+
+    # Another attachment with the same name replaces the file, as can editing it in the vault
+    with open(vault_path, 'rb') as f:
+        return hash_file(f) == digest
+
+
+def verify_attachment_index() -> None:
+    attachment_index.verify('obsidian', is_indexed_file)
 
 
 # def delete_note(note):
@@ -113,7 +146,7 @@ def add_resource(path: str, file_name: str, file_like: IO):
 def attach_text_to_note(path: str, filename: str, file_like: IO, is_html: bool = False) -> None:
     text = file_like.read()
     if is_html:
-        text = H2T.handle(text)
+        text = html_to_markdown(text)
 
     append_to_note(path, filename, text)
 
@@ -142,20 +175,33 @@ def append_to_note(path: str, filename: str, body: str) -> None:
 
 
 def add_pdf_attachment(path: str, filename: str, attachment_name: str, file_like: IO) -> None:
-    add_resource(path, attachment_name, file_like)
-    file_like.seek(0)
-    pdf_text = get_pdf_full_text(file_like)
-    append_to_note(path, filename, f"![[{attachment_name}]]\n\n{pdf_text}")
+    digest = attachment_index.get_digest(file_like)
+    entry = find_indexed_attachment('pdf', digest)
+    if entry is None:
+        add_resource(path, attachment_name, file_like)
+        entry = {'path': path, 'name': attachment_name, 'text': None}
+    if entry['text'] is None:
+        file_like.seek(0)
+        entry['text'] = get_pdf_full_text(file_like)
+        attachment_index.put('obsidian:pdf', digest, dict(entry))
+    append_to_note(path, filename, f"![[{entry['name']}]]\n\n{entry['text']}")
 
 
 def add_img_attachment(path: str, filename: str, attachment_name: str, file_like: IO) -> None:
     if attachment_name.startswith("image"):
         attachment_name = f"{filename[:-3]}{attachment_name[5:]}"
 
-    add_resource(path, attachment_name, file_like)
-    file_like.seek(0)
-    body = f"![[{attachment_name}]]"
-    img_text = get_image_full_text(file_like)
+    digest = attachment_index.get_digest(file_like)
+    entry = find_indexed_attachment('img', digest)
+    if entry is None:
+        add_resource(path, attachment_name, file_like)
+        entry = {'path': path, 'name': attachment_name, 'text': None}
+    if entry['text'] is None:
+        file_like.seek(0)
+        entry['text'] = get_image_full_text(file_like)
+        attachment_index.put('obsidian:img', digest, dict(entry))
+    body = f"![[{entry['name']}]]"
+    img_text = entry['text']
     if len(img_text.strip()) != 0:
         body += f"\n\n{img_text}"
     append_to_note(path, filename, body)
@@ -11,10 +11,23 @@ from todoist_api_python.models import Project, Label, Task, Comment, Section, At
 
 from configuration import todoist_configs
 
+PROJECTS_API_URL = "https://api.todoist.com/api/v1/projects"
+
 token = todoist_configs['api-key']
 api = TodoistAPI(token)
 
 
+def ping(timeout: float) -> None:
+    """Raises when the Todoist API can't be reached or rejects the API key."""
+    try:
+        response = requests.get(PROJECTS_API_URL, params={'limit': 1}, headers={"Authorization": f"Bearer {token}"},
+                                timeout=timeout)
+    except requests.RequestException as exc:
+        raise RuntimeError(f"Todoist API not reachable: {exc}") from exc
+    if response.status_code != requests.codes.ok:
+        raise RuntimeError(f"Received bad status code ({response.status_code}) from the Todoist API")
+
+
 def get_all_projects() -> list[Project]:
     return [project for projects in api.get_projects() for project in projects]
 
@@ -1 +1 @@
-__all__ = ['mail', 'file', 'ocr', 'pdf']
+__all__ = ['mail', 'lazy_mail', 'attachment', 'concurrency', 'file', 'html_markdown', 'kindle', 'ocr', 'pdf', 'state']
@@ -0,0 +1,249 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from email.message import EmailMessage
+from typing import IO, Callable, Iterator, Optional
+
+from configuration import mail_configs, attachment_index_configs
+from enums import MimeType
+from utils.lazy_mail import LazyMessagePart, TransferDecoder
+from utils.state import JsonStateStore
+
+DEFAULT_SPOOL_MAX_SIZE = 4 * 1024 * 1024
+DECODE_CHUNK_SIZE = 64 * 1024
+ATTACHMENT_INDEX_FILE = 'attachment-index.json'
+DEFAULT_INDEX_VERIFY_INTERVAL = 7 * 24 * 60 * 60
+# Extracted text (OCR, PDF) longer than this is not kept in the attachment index
+INDEX_TEXT_MAX_SIZE = 64 * 1024
+# Same escaping of quoted multipart parameters as urllib3
+MULTIPART_ESCAPES = {10: '%0A', 13: '%0D', 34: '%22'}
+
+
+class AttachmentFile(tempfile.SpooledTemporaryFile):
+    """Decoded attachment content, kept in memory up to the spool threshold and overflowing to disk beyond it.
+
+    The same handle is shared by every consumer of the attachment. Command line tools (pdftoppm, pdftotext, tesseract)
+    get a path from get_path(), which writes the content out to a named file at most once.
+    """
+
+    def __init__(self, max_size: Optional[int] = None):
+        if max_size is None:
+            max_size = mail_configs.get('attachment-spool-size', DEFAULT_SPOOL_MAX_SIZE)
+        super().__init__(max_size=max_size, mode='w+b')
+        self.tmpdir: Optional[tempfile.TemporaryDirectory] = None
+        self.file_path: Optional[str] = None
+
+    def get_path(self) -> str:
+        if self.file_path is None:
+            self.tmpdir = tempfile.TemporaryDirectory()
+            self.file_path = os.path.join(self.tmpdir.name, 'attachment')
+            pos = self.tell()
+            self.seek(0)
+            with open(self.file_path, 'wb') as f:
+                shutil.copyfileobj(self, f)
+            self.seek(pos)
+        return self.file_path
+
+    def close(self) -> None:
+        super().close()
+        if self.tmpdir is not None:
+            self.tmpdir.cleanup()
+            self.tmpdir = None
+
+
+def spool_part(part: EmailMessage | LazyMessagePart) -> AttachmentFile:
+    """Decodes the transfer encoding of a MIME part chunk by chunk into an AttachmentFile."""
+    attachment = AttachmentFile()
+    if isinstance(part, LazyMessagePart):
+        part.write_to(attachment)
+    elif (part.get('content-transfer-encoding') or '7bit').lower() in ('base64', 'quoted-printable'):
+        # These payloads are plain ASCII, so they are decoded chunk by chunk
+        decoder = TransferDecoder(part.get('content-transfer-encoding'))
+        payload = part.get_payload()
+        for i in range(0, len(payload), DECODE_CHUNK_SIZE):
+            attachment.write(decoder.decode(payload[i:i + DECODE_CHUNK_SIZE].encode('ascii')))
+        attachment.write(decoder.flush())
+    else:
+        # 7bit, 8bit and binary payloads are kept as text decoded with the part's charset, this gives back the bytes
+        attachment.write(part.get_payload(decode=True) or b'')
+
+    attachment.seek(0)
+    return attachment
+
+
+@contextmanager
+def open_attachment(part: EmailMessage | LazyMessagePart, mime_type: MimeType) -> Iterator[IO]:
+    """Yields the decoded content of an attachment part, as text for text and html parts and as bytes otherwise."""
+    attachment = spool_part(part)
+    try:
+        if mime_type in (MimeType.TEXT, MimeType.HTML):
+            charset = part.get_content_charset() or 'utf-8'
+            try:
+                text_file = io.TextIOWrapper(attachment, encoding=charset, errors='replace')
+            except LookupError:
+                text_file = io.TextIOWrapper(attachment, encoding='utf-8', errors='replace')
+            with text_file:
+                yield text_file
+        else:
+            yield attachment
+    finally:
+        attachment.close()
+
+
+@contextmanager
+def local_file_path(file_like: IO) -> Iterator[str]:
+    """Yields a path on disk holding the content of file_like, only copying it when it is not already a file."""
+    if isinstance(file_like, AttachmentFile):
+        yield file_like.get_path()
+        return
+
+    name = getattr(file_like, 'name', None)
+    if isinstance(name, str) and os.path.isfile(name):
+        yield name
+        return
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmp_file_name = os.path.join(tmpdir, 'tmp')
+        with open(tmp_file_name, mode='wb') as f:
+            shutil.copyfileobj(file_like, f)
+        yield tmp_file_name
+
+
+class MultipartFileStream(io.RawIOBase):
+    """A multipart/form-data request body that reads the file field from its handle while it is being sent.
+
+    requests builds multipart bodies completely in memory, this keeps uploads of large attachments bounded.
+    """
+
+    def __init__(self, fields: dict[str, str], file_field: str, file_name: str, file_like: IO[bytes]):
+        super().__init__()
+        self.boundary = uuid.uuid4().hex
+        head = b''
+        for name, value in fields.items():
+            head += (f"--{self.boundary}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+                     f"{value}\r\n").encode('utf-8')
+        head += (f"--{self.boundary}\r\nContent-Disposition: form-data; name=\"{file_field}\"; "
+                 f"filename=\"{file_name.translate(MULTIPART_ESCAPES)}\"\r\n"
+                 f"Content-Type: application/octet-stream\r\n\r\n").encode('utf-8')
+        tail = f"\r\n--{self.boundary}--\r\n".encode('utf-8')
+
+        start = file_like.tell()
+        file_size = file_like.seek(0, io.SEEK_END) - start
+        file_like.seek(start)
+
+        self.parts = [io.BytesIO(head), file_like, io.BytesIO(tail)]
+        self.length = len(head) + file_size + len(tail)
+        self.position = 0
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return self.length
+
+    def readable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        # requests sends the body with the Content-Length of len() minus tell()
+        return self.position
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.length
+        data = b''
+        while self.parts and len(data) < size:
+            chunk = self.parts[0].read(size - len(data))
+            if not chunk:
+                self.parts.pop(0)
+            else:
+                data += chunk
+        self.position += len(data)
+        return data
+
+
+def hash_file(file_like: IO[bytes]) -> str:
+    """SHA-256 of the remaining content of file_like, which is left at the position it was at."""
+    start = file_like.tell()
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file_like.read(DECODE_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    file_like.seek(start)
+    return digest.hexdigest()
+
+
+class AttachmentIndex:
+    """Content addressed index of stored attachments: SHA-256 of the content -> what was created from it (resource
+    ids, vault path, extracted text), so the same logo or PDF arriving again is linked instead of stored again.
+
+    Entries are namespaced by destination and kind of attachment. Destinations check an entry still points at
+    something that exists before using it, and verify() drops all entries that no longer do.
+    """
+
+    def __init__(self, configs: dict):
+        self.enabled = configs.get('enabled', True)
+        self.verify_interval = configs.get('verify-interval', DEFAULT_INDEX_VERIFY_INTERVAL)
+        self.store: Optional[JsonStateStore] = None
+        self.lock = threading.Lock()
+
+    def get_store(self) -> JsonStateStore:
+        with self.lock:
+            if self.store is None:
+                self.store = JsonStateStore(ATTACHMENT_INDEX_FILE)
+            return self.store
+
+    def get_digest(self, file_like: IO) -> Optional[str]:
+        if not self.enabled or isinstance(file_like, io.TextIOBase):
+            return None
+        return hash_file(file_like)
+
+    def get(self, namespace: str, digest: Optional[str]) -> Optional[dict]:
+        if digest is None:
+            return None
+        return self.get_store().get(f"{namespace}:{digest}")
+
+    def put(self, namespace: str, digest: Optional[str], entry: dict) -> None:
+        if digest is None:
+            return
+        if len(entry.get('text') or '') > INDEX_TEXT_MAX_SIZE:
+            # Too large to keep in the index, it is extracted again when the attachment comes back
+            entry['text'] = None
+        store = self.get_store()
+        store.set(f"{namespace}:{digest}", entry)
+        store.save()
+
+    def drop(self, namespace: str, digest: str) -> None:
+        store = self.get_store()
+        store.delete(f"{namespace}:{digest}")
+        store.save()
+
+    def verify(self, namespace: str, exists: Callable[[str, dict], bool]) -> None:
+        """Drops the entries of the namespace whose stored attachment is gone or replaced, at most once every
+        verify-interval."""
+        if not self.enabled:
+            return
+
+        store = self.get_store()
+        verified_key = f"verified:{namespace}"
+        if time.time() - store.get(verified_key, 0) < self.verify_interval:
+            return
+
+        dropped = 0
+        for key, entry in store.items():
+            if key.startswith(namespace + ':') and not exists(key[len(namespace) + 1:], entry):
+                store.delete(key)
+                dropped += 1
+        if dropped > 0:
+            print(f"Dropped {dropped} deleted or replaced attachments from the {namespace} attachment index")
+        store.set(verified_key, time.time())
+        store.save()
+
+
+attachment_index = AttachmentIndex(attachment_index_configs)
@@ -0,0 +1,78 @@
+import io
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TextIO
+
+
+class ThreadOutput(io.TextIOBase):
+    """Stand-in for sys.stdout that lets worker threads buffer their prints instead of interleaving them."""
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+        self.local = threading.local()
+
+    def get_stream(self) -> TextIO:
+        buffer = getattr(self.local, 'buffer', None)
+        return buffer if buffer is not None else self.stream
+
+    def write(self, s: str) -> int:
+        return self.get_stream().write(s)
+
+    def flush(self) -> None:
+        self.get_stream().flush()
+
+    def capture(self, buffer: io.StringIO | None) -> None:
+        self.local.buffer = buffer
+
+
+thread_output_lock = threading.Lock()
+
+
+def get_thread_output() -> ThreadOutput:
+    with thread_output_lock:
+        if not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout = ThreadOutput(sys.stdout)
+        return sys.stdout
+
+
+def run_concurrently(tasks: list[Callable[[], Any]], max_workers: int) -> list[Exception]:
+    """Runs the tasks on up to max_workers threads and returns the exceptions raised by the failed ones.
+
+    The output printed by each task is buffered and written out in task order, so logs read the same as a sequential
+    run no matter how the tasks interleave. With max_workers of 1 the tasks simply run one after another.
+    """
+    errors = []
+    if max_workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            try:
+                task()
+            except Exception as exc:
+                traceback.print_exc()
+                errors.append(exc)
+        return errors
+
+    output = get_thread_output()
+
+    def run_task(task: Callable[[], Any]) -> tuple[str, Exception | None]:
+        buffer = io.StringIO()
+        output.capture(buffer)
+        try:
+            task()
+            return buffer.getvalue(), None
+        except Exception as exc:
+            traceback.print_exc(file=buffer)
+            return buffer.getvalue(), exc
+        finally:
+            output.capture(None)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_task, task) for task in tasks]
+        for future in futures:
+            task_output, error = future.result()
+            output.write(task_output)
+            if error is not None:
+                errors.append(error)
+
+    return errors
@@ -0,0 +1,91 @@
+import threading
+import time
+from typing import Callable, Optional
+
+from utils.state import JsonStateStore
+
+HEALTH_STATE_FILE = 'service-health.json'
+DEFAULT_PROBE_TIMEOUT = 5
+DEFAULT_RETRY_INTERVAL = 0
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker:
+    """Availability of an external service, decided by a cheap probe before the jobs that depend on it run.
+
+    While the circuit is closed every check probes the service. A failed probe opens it: checks then fail immediately,
+    without calling the service, until retry-interval seconds have passed. The next check after that is half-open and
+    probes again, closing the circuit on success and opening it for another interval on failure.
+
+    An open circuit is saved in the state directory, so runs started by cron keep waiting out the retry interval and
+    only the run that opens it sees just_opened.
+    """
+
+    def __init__(self, name: str, probe: Callable[[float], None], configs: dict):
+        self.name = name
+        self.probe = probe
+        self.probe_timeout = configs.get('probe-timeout', DEFAULT_PROBE_TIMEOUT)
+        self.retry_interval = configs.get('retry-interval', DEFAULT_RETRY_INTERVAL)
+        self.state = CLOSED
+        # Wall clock time, as it is compared with the one saved by an earlier run
+        self.opened_at = 0.0
+        self.failures = 0
+        self.error: Optional[str] = None
+        # Whether the last check opened the circuit of a service that was available until then
+        self.just_opened = False
+        self.store: Optional[JsonStateStore] = None
+        self.lock = threading.Lock()
+
+    def load(self) -> None:
+        if self.store is not None:
+            return
+        self.store = JsonStateStore(HEALTH_STATE_FILE)
+        saved = self.store.get(self.name)
+        if saved is not None:
+            self.state = OPEN
+            self.opened_at = saved['opened-at']
+            self.failures = saved['failures']
+            self.error = saved['error']
+
+    def save(self) -> None:
+        if self.state == OPEN:
+            self.store.set(self.name, {'opened-at': self.opened_at, 'failures': self.failures, 'error': self.error})
+        else:
+            self.store.delete(self.name)
+        self.store.save()
+
+    def check(self) -> bool:
+        with self.lock:
+            self.load()
+            self.just_opened = False
+            if self.state == OPEN:
+                if 0 <= time.time() - self.opened_at < self.retry_interval:
+                    return False
+                self.state = HALF_OPEN
+
+            try:
+                self.probe(self.probe_timeout)
+            except Exception as exc:
+                self.just_opened = self.state == CLOSED
+                self.state = OPEN
+                self.opened_at = time.time()
+                self.failures += 1
+                self.error = str(exc) or type(exc).__name__
+                self.save()
+                return False
+
+            self.state = CLOSED
+            if self.failures > 0:
+                print(f"{self.name} is available again")
+                self.failures = 0
+                self.error = None
+                self.save()
+            return True
+
+    def is_available(self) -> bool:
+        """State of the last check, without probing."""
+        with self.lock:
+            return self.state != OPEN
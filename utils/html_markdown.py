@@ -0,0 +1,119 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+import html2text
+
+from configuration import html_configs
+
+DEFAULT_CACHE_SIZE = 128
+
+FENCE = '```'
+LIST_ITEM_PATTERN = re.compile(r'^( *)([-*+]|\d+\.) ')
+TABLE_SEPARATOR_CELL_PATTERN = re.compile(r'^(:?)-+(:?)$')
+# html2text escapes a dash that starts a text run even in the middle of a line, e.g. after a link
+INLINE_DASH_ESCAPE_PATTERN = re.compile(r'(?<=\S) \\-(?=\s)')
+
+
+class HtmlConverter:
+    """Converts HTML to markdown locally with html2text, set up close to Joplin's own conversion (ATX headings, '-'
+    bullets, '*' emphasis, fenced code blocks and no hard wrapping).
+
+    The output is tidied to Joplin's layout where html2text's differs: single blank lines, code fences without the
+    trailing blank line, list items indented four spaces per level, table cells without padding and no escaped dashes
+    in the middle of a line.
+
+    Results are memoized by a hash of the HTML, as the same signatures and newsletters keep coming back.
+    """
+
+    def __init__(self, configs: dict):
+        self.body_width = configs.get('body-width', 0)
+        self.cache_size = configs.get('cache-size', DEFAULT_CACHE_SIZE)
+        self.cache: OrderedDict[bytes, str] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def create_parser(self) -> html2text.HTML2Text:
+        # HTML2Text keeps state between documents, so every conversion gets its own parser
+        parser = html2text.HTML2Text()
+        parser.body_width = self.body_width
+        parser.ul_item_mark = '-'
+        parser.emphasis_mark = '*'
+        parser.strong_mark = '**'
+        parser.backquote_code_style = True
+        parser.unicode_snob = True
+        # Tables with outer pipes, like Joplin's GFM tables
+        parser.pad_tables = True
+        return parser
+
+    def convert(self, html: str) -> str:
+        key = hashlib.sha256(html.encode('utf-8', 'surrogatepass')).digest()
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        markdown = tidy_markdown(self.create_parser().handle(html)).strip('\n')
+
+        with self.lock:
+            self.cache[key] = markdown
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return markdown
+
+
+def tidy_table_row(line: str) -> str:
+    cells = [cell.strip() for cell in line.strip().strip('|').split('|')]
+    if all(TABLE_SEPARATOR_CELL_PATTERN.match(cell) for cell in cells):
+        cells = [TABLE_SEPARATOR_CELL_PATTERN.sub(r'\1---\2', cell) for cell in cells]
+    return '| ' + ' | '.join(cells) + ' |'
+
+
+def tidy_markdown(markdown: str) -> str:
+    lines = []
+    in_fence = False
+    # html2text indents of the list levels currently open
+    list_indents: list[int] = []
+    for line in markdown.splitlines():
+        if line.strip() == FENCE:
+            if in_fence:
+                while lines and not lines[-1].strip():
+                    lines.pop()
+            elif lines and lines[-1].strip():
+                lines.append('')
+            lines.append(line.rstrip())
+            in_fence = not in_fence
+            continue
+        if in_fence:
+            lines.append(line)
+            continue
+        if not line.strip():
+            if lines and lines[-1]:
+                lines.append('')
+            continue
+        if line.startswith('|'):
+            lines.append(tidy_table_row(line))
+            continue
+
+        match = LIST_ITEM_PATTERN.match(line)
+        if match:
+            indent = len(match.group(1))
+            while list_indents and list_indents[-1] > indent:
+                list_indents.pop()
+            if not list_indents or list_indents[-1] < indent:
+                list_indents.append(indent)
+            line = '    ' * (len(list_indents) - 1) + line[indent:]
+        elif list_indents and line.startswith(' '):
+            # Continuation of the last item, indented under its text
+            line = '    ' * len(list_indents) + line.lstrip(' ')
+        else:
+            list_indents = []
+        lines.append(INLINE_DASH_ESCAPE_PATTERN.sub(' -', line))
+    return '\n'.join(lines)
+
+
+html_converter = HtmlConverter(html_configs)
+
+
+def html_to_markdown(html: str) -> str:
+    return html_converter.convert(html)
@@ -0,0 +1,104 @@
+import base64
+from typing import NamedTuple
+
+from configuration import kindle_configs
+
+# Document types accepted by Send to Kindle over e-mail
+SUPPORTED_EXTENSIONS = ['doc', 'docx', 'epub', 'htm', 'html', 'pdf', 'rtf', 'txt', 'bmp', 'gif', 'jpeg', 'jpg', 'png']
+MIME_TYPE_EXTENSIONS = {
+    'application/msword': 'doc',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': 'docx',
+    'application/epub+zip': 'epub',
+    'text/html': 'html',
+    'application/pdf': 'pdf',
+    'application/rtf': 'rtf',
+    'text/rtf': 'rtf',
+    'text/plain': 'txt',
+    'image/bmp': 'bmp',
+    'image/gif': 'gif',
+    'image/jpeg': 'jpg',
+    'image/png': 'png',
+}
+# Send to Kindle rejects e-mails over 50 MB (after encoding) or with more than 25 attachments
+DEFAULT_MAX_MESSAGE_SIZE = 50 * 1024 * 1024
+DEFAULT_MAX_ATTACHMENTS = 25
+# Room for the message headers and the MIME headers of every attachment part
+MESSAGE_OVERHEAD = 4 * 1024
+PART_OVERHEAD = 1024
+
+
+class SkippedResource(NamedTuple):
+    resource: dict
+    reason: str
+
+
+class KindleDeliveryPlan(NamedTuple):
+    # The resources of each e-mail to send, in note order
+    messages: list[list[dict]]
+    skipped: list[SkippedResource]
+
+
+def get_encoded_size(size: int) -> int:
+    """Size of an attachment of size bytes once base64 encoded in 76 character lines."""
+    encoded = 4 * ((size + 2) // 3)
+    return encoded + 2 * ((encoded + base64.MAXLINESIZE - 1) // base64.MAXLINESIZE) + PART_OVERHEAD
+
+
+class KindleDeliveryPlanner:
+    """Chooses the resources of a note that Send to Kindle accepts and packs them into as few e-mails as the size and
+    attachment count limits allow.
+
+    Everything is decided from the resource metadata (mime, file_extension, size), so resources that would be
+    rejected are never downloaded.
+    """
+
+    def __init__(self, configs: dict):
+        self.extensions = {extension.lower() for extension in configs.get('extensions', SUPPORTED_EXTENSIONS)}
+        self.max_message_size = configs.get('max-message-size', DEFAULT_MAX_MESSAGE_SIZE)
+        self.max_attachments = configs.get('max-attachments', DEFAULT_MAX_ATTACHMENTS)
+
+    def get_extension(self, resource: dict) -> str:
+        extension = (resource.get('file_extension') or '').lower()
+        if not extension and '.' in (resource.get('filename') or ''):
+            extension = resource['filename'].rsplit('.', 1)[1].lower()
+        if extension not in self.extensions:
+            extension = MIME_TYPE_EXTENSIONS.get(resource.get('mime'), extension)
+        return extension
+
+    def get_attachment_name(self, resource: dict) -> str:
+        # Send to Kindle goes by the file name to recognize the document type
+        name = resource['title'] or resource['id']
+        extension = self.get_extension(resource)
+        return name if name.lower().endswith(f".{extension}") else f"{name}.{extension}"
+
+    def plan(self, resources: list[dict]) -> KindleDeliveryPlan:
+        skipped = []
+        candidates = []
+        for index, resource in enumerate(resources):
+            if self.get_extension(resource) not in self.extensions:
+                skipped.append(SkippedResource(resource, f"unsupported format {resource.get('mime')}"))
+            elif MESSAGE_OVERHEAD + get_encoded_size(resource.get('size') or 0) > self.max_message_size:
+                skipped.append(SkippedResource(resource, f"too large ({resource['size']} bytes)"))
+            else:
+                candidates.append((index, resource))
+
+        # First fit decreasing: each resource goes into the first e-mail with room left for it, largest first
+        messages: list[list[tuple[int, dict]]] = []
+        message_sizes: list[int] = []
+        for index, resource in sorted(candidates, key=lambda candidate: candidate[1].get('size') or 0, reverse=True):
+            size = get_encoded_size(resource.get('size') or 0)
+            for i, message in enumerate(messages):
+                if len(message) < self.max_attachments and message_sizes[i] + size <= self.max_message_size:
+                    message.append((index, resource))
+                    message_sizes[i] += size
+                    break
+            else:
+                messages.append([(index, resource)])
+                message_sizes.append(MESSAGE_OVERHEAD + size)
+
+        messages.sort(key=lambda message: min(index for index, _ in message))
+        return KindleDeliveryPlan([[resource for _, resource in sorted(message, key=lambda item: item[0])]
+                                   for message in messages], skipped)
+
+
+kindle_planner = KindleDeliveryPlanner(kindle_configs)
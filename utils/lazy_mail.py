@@ -0,0 +1,387 @@
+import binascii
+import email
+import quopri
+import re
+from email.header import decode_header, make_header
+from email.message import EmailMessage
+from email.parser import BytesHeaderParser
+from email.policy import default
+from email.utils import collapse_rfc2231_value, decode_rfc2231
+from typing import IO, Any, Iterator, Optional
+
+from configuration import mail_configs
+
+DEFAULT_PARTIAL_FETCH_CHUNK_SIZE = 1024 * 1024
+
+TOKEN_PATTERN = re.compile(rb'\s*(?:(?P<open>\()|(?P<close>\))|"(?P<quoted>(?:[^"\\]|\\.)*)"'
+                           rb'|\{(?P<literal>\d+)\}\s*$|(?P<atom>[^\s()"]+))')
+QUOTED_ESCAPE_PATTERN = re.compile(rb'\\(.)')
+BASE64_IGNORED_PATTERN = re.compile(rb'[^A-Za-z0-9+/=]')
+
+# Python's email package treats the first of each of these inline parts as part of the body, not as an attachment
+BODY_TYPES = {('text', 'plain'), ('text', 'html'), ('multipart', 'related'), ('multipart', 'alternative')}
+
+
+class Literal(bytes):
+    pass
+
+
+def tokenize_fetch_response(data: list) -> Iterator:
+    for item in data:
+        pieces = [item[0], Literal(item[1])] if isinstance(item, tuple) else [item]
+        for piece in pieces:
+            if isinstance(piece, Literal):
+                yield piece
+                continue
+
+            pos = 0
+            while pos < len(piece):
+                match = TOKEN_PATTERN.match(piece, pos)
+                if match is None or match.end() == pos:
+                    break
+                pos = match.end()
+
+                if match.group('open'):
+                    yield '('
+                elif match.group('close'):
+                    yield ')'
+                elif match.group('quoted') is not None:
+                    yield QUOTED_ESCAPE_PATTERN.sub(rb'\1', match.group('quoted'))
+                elif match.group('atom') is not None:
+                    atom = match.group('atom')
+                    yield None if atom.upper() == b'NIL' else atom
+                # Literal markers are followed by the literal itself as the next piece
+
+
+def parse_fetch_items(data: list) -> list[dict[str, Any]]:
+    """Parses the data of an imaplib FETCH response into one {item name: value} dict per message.
+
+    Lists are returned as python lists, strings and literals as bytes and NIL as None. Item names are upper case,
+    e.g. 'UID', 'BODYSTRUCTURE' or 'BODY[1.MIME]'.
+    """
+    def parse_list(tokens: Iterator) -> list:
+        values = []
+        for token in tokens:
+            if token == '(':
+                values.append(parse_list(tokens))
+            elif token == ')':
+                return values
+            else:
+                values.append(token)
+        return values
+
+    responses = []
+    tokens = tokenize_fetch_response(data)
+    for token in tokens:
+        if token != '(':
+            # Message sequence number
+            continue
+
+        values = parse_list(tokens)
+        items = {}
+        for i in range(0, len(values) - 1, 2):
+            if isinstance(values[i], bytes):
+                items[str(values[i], 'ascii').upper()] = values[i + 1]
+        responses.append(items)
+
+    return responses
+
+
+def to_str(value: Optional[bytes]) -> Optional[str]:
+    if value is None:
+        return None
+    return str(value, 'utf-8', errors='replace')
+
+
+def to_params(values: Optional[list]) -> dict[str, str]:
+    if not isinstance(values, list):
+        return {}
+
+    params = {}
+    for i in range(0, len(values) - 1, 2):
+        params[to_str(values[i]).lower()] = to_str(values[i + 1])
+    return params
+
+
+def decode_param(params: dict[str, str], name: str) -> Optional[str]:
+    if f"{name}*" in params:
+        return collapse_rfc2231_value(decode_rfc2231(params[f"{name}*"]))
+    if name not in params or params[name] is None:
+        return None
+
+    try:
+        return str(make_header(decode_header(params[name])))
+    except (ValueError, LookupError):
+        return params[name]
+
+
+class TransferDecoder:
+    """Incrementally decodes a Content-Transfer-Encoding so large parts can be processed chunk by chunk."""
+
+    def __init__(self, encoding: Optional[str]):
+        self.encoding = (encoding or '7bit').lower()
+        self.remainder = b''
+
+    def decode(self, data: bytes) -> bytes:
+        if self.encoding == 'base64':
+            data = self.remainder + BASE64_IGNORED_PATTERN.sub(b'', data)
+            usable = len(data) - len(data) % 4
+            self.remainder = data[usable:]
+            return binascii.a2b_base64(data[:usable])
+        elif self.encoding == 'quoted-printable':
+            # Soft line breaks and escapes never span lines, so only complete lines are decoded
+            data = self.remainder + data
+            end = data.rfind(b'\n') + 1
+            self.remainder = data[end:]
+            return quopri.decodestring(data[:end])
+        else:
+            return data
+
+    def flush(self) -> bytes:
+        remainder, self.remainder = self.remainder, b''
+        if not remainder:
+            return b''
+
+        if self.encoding == 'base64':
+            try:
+                return binascii.a2b_base64(remainder + b'=' * (-len(remainder) % 4))
+            except binascii.Error:
+                return b''
+        elif self.encoding == 'quoted-printable':
+            return quopri.decodestring(remainder)
+        else:
+            return remainder
+
+
+class LazyMessagePart:
+    """A MIME part described by its IMAP BODYSTRUCTURE whose content is only fetched when accessed.
+
+    Mirrors the parts of the EmailMessage API used by the mail jobs (get_body, iter_attachments, get_content, ...) so it
+    can be used in place of a fully downloaded message.
+    """
+
+    def __init__(self, session, uid: int, section: str, structure: list, root: Optional['LazyEmailMessage'] = None):
+        self.session = session
+        self.uid = uid
+        self.section = section
+        self.root = root if root is not None else self
+        self.parts: list[LazyMessagePart] = []
+
+        if structure and isinstance(structure[0], list):
+            prefix = f"{section}." if section else ''
+            i = 0
+            while i < len(structure) and isinstance(structure[i], list):
+                self.parts.append(LazyMessagePart(session, uid, f"{prefix}{i + 1}", structure[i], self.root))
+                i += 1
+
+            self.maintype = 'multipart'
+            self.subtype = to_str(structure[i]).lower() if i < len(structure) else 'mixed'
+            extension = structure[i + 1:]
+            self.params = to_params(extension[0] if len(extension) > 0 else None)
+            disposition = extension[1] if len(extension) > 1 else None
+            self.content_id = None
+            self.encoding = None
+            self.size = 0
+        else:
+            self.maintype = to_str(structure[0]).lower()
+            self.subtype = to_str(structure[1]).lower()
+            self.params = to_params(structure[2])
+            self.content_id = to_str(structure[3])
+            self.encoding = to_str(structure[5])
+            self.size = int(structure[6]) if structure[6] is not None else 0
+
+            if self.maintype == 'text':
+                extension_start = 8
+            elif self.maintype == 'message' and self.subtype == 'rfc822':
+                extension_start = 10
+            else:
+                extension_start = 7
+            disposition = structure[extension_start + 1] if len(structure) > extension_start + 1 else None
+
+        if isinstance(disposition, list) and disposition:
+            self.disposition = to_str(disposition[0]).lower()
+            self.disposition_params = to_params(disposition[1] if len(disposition) > 1 else None)
+        else:
+            self.disposition = None
+            self.disposition_params = {}
+
+    def __getitem__(self, name: str) -> Optional[str]:
+        return self.get(name)
+
+    def get(self, name: str, failobj: Any = None) -> Any:
+        name = name.lower()
+        if name == 'content-id':
+            return self.content_id if self.content_id is not None else failobj
+        elif name == 'content-type':
+            return self.get_content_type()
+        elif name == 'content-disposition':
+            return self.disposition if self.disposition is not None else failobj
+        return failobj
+
+    def get_content_type(self) -> str:
+        return f"{self.maintype}/{self.subtype}"
+
+    def get_content_maintype(self) -> str:
+        return self.maintype
+
+    def get_content_subtype(self) -> str:
+        return self.subtype
+
+    def get_param(self, name: str, failobj: Any = None) -> Any:
+        value = decode_param(self.params, name.lower())
+        return value if value is not None else failobj
+
+    def get_content_charset(self, failobj: Any = None) -> Any:
+        charset = self.get_param('charset')
+        return charset.lower() if charset else failobj
+
+    def get_filename(self, failobj: Any = None) -> Any:
+        filename = decode_param(self.disposition_params, 'filename')
+        if filename is None:
+            filename = decode_param(self.params, 'name')
+        return filename if filename is not None else failobj
+
+    def is_multipart(self) -> bool:
+        return self.maintype == 'multipart' or (self.maintype == 'message' and self.subtype == 'rfc822')
+
+    def is_attachment(self) -> bool:
+        return self.disposition == 'attachment'
+
+    def iter_parts(self) -> Iterator['LazyMessagePart']:
+        yield from self.parts
+
+    def find_body(self, part: 'LazyMessagePart', preferencelist: tuple) -> Iterator[tuple[int, 'LazyMessagePart']]:
+        if part.is_attachment():
+            return
+
+        if part.maintype == 'text':
+            if part.subtype in preferencelist:
+                yield preferencelist.index(part.subtype), part
+            return
+
+        if part.maintype != 'multipart':
+            return
+
+        if part.subtype != 'related':
+            for subpart in part.iter_parts():
+                yield from self.find_body(subpart, preferencelist)
+            return
+
+        if 'related' in preferencelist:
+            yield preferencelist.index('related'), part
+
+        start = part.get_param('start')
+        candidate = next((p for p in part.parts if start and p.content_id == start), None)
+        if candidate is None and part.parts:
+            candidate = part.parts[0]
+        if candidate is not None:
+            yield from self.find_body(candidate, preferencelist)
+
+    def get_body(self, preferencelist: tuple = ('related', 'html', 'plain')) -> Optional['LazyMessagePart']:
+        best_prio = len(preferencelist)
+        body = None
+        for prio, part in self.find_body(self, preferencelist):
+            if prio < best_prio:
+                best_prio = prio
+                body = part
+                if prio == 0:
+                    break
+        return body
+
+    def iter_attachments(self) -> Iterator['LazyMessagePart']:
+        if self.maintype != 'multipart' or self.subtype == 'alternative':
+            return
+
+        parts = list(self.parts)
+        if self.subtype == 'related':
+            start = self.get_param('start')
+            if start and any(p.content_id == start for p in parts):
+                yield from (p for p in parts if p.content_id != start)
+            else:
+                yield from parts[1:]
+            return
+
+        seen = []
+        for part in parts:
+            if (part.maintype, part.subtype) in BODY_TYPES and not part.is_attachment() and part.subtype not in seen:
+                seen.append(part.subtype)
+                continue
+            yield part
+
+    def fetch_section(self, section: str, partial: Optional[tuple[int, int]] = None) -> bytes:
+        fetch_item = f"BODY.PEEK[{section}]" if partial is None else f"BODY.PEEK[{section}]<{partial[0]}.{partial[1]}>"
+        result, data = self.session.mail.uid('FETCH', str(self.uid), f"({fetch_item})")
+        if result != 'OK':
+            raise RuntimeError(f"Unable to fetch {fetch_item} of mail {self.uid}: {result} - {data}")
+
+        key_prefix = f"BODY[{section.upper()}]"
+        for items in parse_fetch_items(data):
+            for key, value in items.items():
+                if key.startswith(key_prefix):
+                    return value if value is not None else b''
+
+        raise RuntimeError(f"Missing {fetch_item} in fetch response for mail {self.uid}")
+
+    def load(self) -> EmailMessage:
+        if self.section == self.root.section:
+            mime_headers = self.root.header_bytes
+            content = self.fetch_section('TEXT')
+        else:
+            mime_headers = self.fetch_section(f"{self.section}.MIME")
+            content = self.fetch_section(self.section)
+
+        return email.message_from_bytes(mime_headers + content, policy=default)
+
+    def get_content(self, *args, **kw) -> Any:
+        return self.load().get_content(*args, **kw)
+
+    def write_to(self, file_like: IO[bytes]) -> int:
+        """Streams the decoded content of this part into file_like using partial fetches and returns its size."""
+        chunk_size = mail_configs.get('partial-fetch-chunk-size', DEFAULT_PARTIAL_FETCH_CHUNK_SIZE)
+        section = 'TEXT' if self.section == self.root.section else self.section
+        decoder = TransferDecoder(self.encoding)
+
+        written = 0
+        offset = 0
+        while True:
+            chunk = self.fetch_section(section, (offset, chunk_size))
+            written += file_like.write(decoder.decode(chunk))
+            offset += len(chunk)
+            if len(chunk) < chunk_size:
+                break
+
+        written += file_like.write(decoder.flush())
+        return written
+
+
+class LazyEmailMessage(LazyMessagePart):
+    """A message for which only the headers and BODYSTRUCTURE have been fetched."""
+
+    def __init__(self, session, uid: int, structure: list, header_bytes: bytes):
+        self.header_bytes = header_bytes
+        self.headers = BytesHeaderParser(policy=default).parsebytes(header_bytes)
+        # A single part message has its content in section TEXT, the parts of a multipart message are numbered from 1
+        super().__init__(session, uid, '', structure)
+
+    def get(self, name: str, failobj: Any = None) -> Any:
+        return self.headers.get(name, failobj)
+
+    def get_filename(self, failobj: Any = None) -> Any:
+        return self.headers.get_filename(failobj)
+
+
+def fetch_lazy_messages(session, uid_set: str) -> dict[int, LazyEmailMessage]:
+    result, data = session.mail.uid('FETCH', uid_set, '(UID BODYSTRUCTURE BODY.PEEK[HEADER])')
+    if result != 'OK':
+        print(f"Failed to retrieve mail {uid_set} from mailbox {session.mailbox}: {result} - {data}")
+        return {}
+
+    messages = {}
+    for items in parse_fetch_items(data):
+        if 'UID' not in items or 'BODYSTRUCTURE' not in items or 'BODY[HEADER]' not in items:
+            continue
+
+        uid = int(items['UID'])
+        messages[uid] = LazyEmailMessage(session, uid, items['BODYSTRUCTURE'], items['BODY[HEADER]'])
+
+    return dict(sorted(messages.items()))
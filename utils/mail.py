@@ -1,107 +1,512 @@
 import datetime
 import email
 import imaplib
+import queue
 import re
+import select
 import smtplib
 import ssl
+import threading
+import time
 from email.message import EmailMessage
+from email.parser import BytesHeaderParser
 from email.policy import default
+from typing import Any, Callable, Iterable, Iterator, Optional
 
 from configuration import mail_configs, joplin_configs
 from constants import PDF_MIME_TYPE, PNG_MIME_TYPE
-from enums import MimeType
+from enums import FetchMode, MimeType
+from utils.lazy_mail import LazyEmailMessage, fetch_lazy_messages
+from utils.state import JsonStateStore
 
-UID_PATTERN = re.compile(r'\d+ \(UID (?P<uid>\d+) RFC822.*')
+UID_PATTERN = re.compile(rb'UID (?P<uid>\d+)')
 GM_MSGID_PATTERN = re.compile(r'\d+ \(X-GM-MSGID (?P<uid>\d+) RFC822.*')
 
-
-def send_mail(msg, to_addr):
-    context = ssl.create_default_context()
-    with smtplib.SMTP_SSL(host=mail_configs['smtp']['server'], port=mail_configs['smtp']['port'],
-                          context=context) as server:
-        server.login(mail_configs['smtp']['username'], mail_configs['smtp']['password'])
+DEFAULT_FETCH_BATCH_SIZE = 200
+DEFAULT_SMTP_NOOP_INTERVAL = 60
+
+UIDNEXT_PATTERN = re.compile(rb'UIDNEXT (?P<uidnext>\d+)')
+UIDVALIDITY_PATTERN = re.compile(rb'UIDVALIDITY (?P<uidvalidity>\d+)')
+
+MAIL_CHECKPOINTS_FILE = 'mail-checkpoints.json'
+
+EXISTS_PATTERN = re.compile(rb'\* \d+ EXISTS')
+# RFC 2177 servers may drop an IDLE connection after 30 minutes of inactivity
+IDLE_RENEW_INTERVAL = 29 * 60
+WATCHER_RECONNECT_DELAY = 60
+
+
+class SmtpSession:
+    """One authenticated SMTP connection kept open for the whole run (or daemon lifetime).
+
+    Idle connections are checked with NOOP before reuse and are re-established transparently when the server has
+    dropped them.
+    """
+
+    def __init__(self, smtp_configs: dict):
+        self.smtp_configs = smtp_configs
+        self.noop_interval = smtp_configs.get('noop-interval', DEFAULT_SMTP_NOOP_INTERVAL)
+        self.server: Optional[smtplib.SMTP_SSL] = None
+        self.last_used = 0.0
+        self.lock = threading.RLock()
+
+    def __enter__(self) -> 'SmtpSession':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def connect(self) -> None:
+        self.close()
+        context = ssl.create_default_context()
+        server = smtplib.SMTP_SSL(host=self.smtp_configs['server'], port=self.smtp_configs['port'], context=context)
+        server.login(self.smtp_configs['username'], self.smtp_configs['password'])
+        self.server = server
+        self.last_used = time.monotonic()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.server is None:
+                return
+
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                self.server.close()
+            self.server = None
+
+    def is_alive(self) -> bool:
+        if self.server is None:
+            return False
+
+        if time.monotonic() - self.last_used < self.noop_interval:
+            return True
+
+        try:
+            status, _ = self.server.noop()
+            return status == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def deliver(self, send: Callable[[smtplib.SMTP_SSL], Any]) -> None:
+        with self.lock:
+            if not self.is_alive():
+                self.connect()
+
+            try:
+                send(self.server)
+            except smtplib.SMTPServerDisconnected:
+                self.connect()
+                send(self.server)
+            self.last_used = time.monotonic()
+
+    def send(self, msg, to_addr) -> None:
         del msg["To"]
         msg["To"] = to_addr
-        server.send_message(msg, mail_configs['smtp']['username'], to_addr)
+        self.deliver(lambda server: server.send_message(msg, self.smtp_configs['username'], to_addr))
+
+    def send_raw(self, raw: bytes, to_addr: str) -> None:
+        # Same header handling as send_message: the recipient replaces To and Bcc never leaves the envelope
+        raw = rewrite_raw_headers(raw, {'to', 'bcc', 'resent-bcc'}, {'To': to_addr})
+
+        def send(server: smtplib.SMTP_SSL) -> None:
+            mail_options = ['BODY=8BITMIME'] if not raw.isascii() and server.has_extn('8bitmime') else []
+            server.sendmail(self.smtp_configs['username'], [to_addr], raw, mail_options)
+
+        self.deliver(send)
+
+    def send_many(self, messages: Iterable[tuple[EmailMessage, str]]) -> None:
+        with self.lock:
+            for msg, to_addr in messages:
+                self.send(msg, to_addr)
+
+
+smtp_session = SmtpSession(mail_configs['smtp'])
+
+
+def send_mail(msg, to_addr):
+    smtp_session.send(msg, to_addr)
+
+
+def send_raw_mail(raw: bytes, to_addr: str) -> None:
+    smtp_session.send_raw(raw, to_addr)
+
+
+def send_many(messages: Iterable[tuple[EmailMessage, str]]) -> None:
+    smtp_session.send_many(messages)
+
 
+def split_raw_headers(raw: bytes) -> tuple[bytes, bytes, bytes]:
+    for separator in (b'\r\n', b'\n'):
+        header_end = raw.find(separator * 2)
+        if header_end >= 0:
+            return raw[:header_end], raw[header_end:], separator
+    return raw, b'', b'\r\n'
 
-def get_mail_client(host: str, port: int, username: str, password: str, mailbox: str) -> imaplib.IMAP4_SSL:
+
+def rewrite_raw_headers(raw: bytes, remove: set[str], add: dict[str, str]) -> bytes:
+    """Drops the named headers (with their folded continuation lines) from the raw message and appends new ones,
+    leaving every other byte of the message untouched."""
+    header_block, rest, separator = split_raw_headers(raw)
+
+    lines = []
+    skipping = False
+    for line in header_block.split(separator):
+        if line[:1] not in (b' ', b'\t'):
+            skipping = str(line.split(b':', 1)[0], 'ascii', errors='replace').strip().lower() in remove
+        if not skipping:
+            lines.append(line)
+
+    lines.extend(f"{name}: {value}".encode('utf-8') for name, value in add.items())
+    return separator.join(lines) + rest
+
+
+class RawEmailMessage:
+    """The original bytes of a message with only its headers parsed, for logging and routing."""
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self.headers = BytesHeaderParser(policy=default).parsebytes(split_raw_headers(raw)[0] + b'\r\n\r\n')
+
+    def __getitem__(self, name: str) -> Any:
+        return self.headers[name]
+
+    def get(self, name: str, failobj: Any = None) -> Any:
+        return self.headers.get(name, failobj)
+
+
+def get_mail_client(host: str, port: int, username: str, password: str) -> imaplib.IMAP4_SSL:
     mail = imaplib.IMAP4_SSL(host=host, port=port)
     result, data = mail.login(username, password)
     if result != 'OK':
         raise RuntimeError(f"Unable to login to mail server: {result} - {data}")
 
-    result, data = mail.select(mailbox)
-    if result != 'OK':
-        raise RuntimeError(f"Unable to select mailbox {mailbox}: {result} - {data}")
-
     return mail
 
 
-def fetch_mail(host: str, port: int, username: str, password: str, mailbox: str) -> dict[int, EmailMessage]:
-    messages = {}
+mail_checkpoints: Optional[JsonStateStore] = None
+mail_checkpoints_lock = threading.Lock()
+
+
+def get_mail_checkpoints() -> Optional[JsonStateStore]:
+    global mail_checkpoints
+    if not mail_configs.get('incremental-sync', True):
+        return None
+
+    with mail_checkpoints_lock:
+        if mail_checkpoints is None:
+            mail_checkpoints = JsonStateStore(MAIL_CHECKPOINTS_FILE)
+        return mail_checkpoints
 
-    with get_mail_client(host, port, username, password, mailbox) as mail:
-        resp, items = mail.search(None, 'All')
+
+class MailSession:
+    """One authenticated IMAP connection for an account, shared by the mail jobs.
+
+    Archive requests are queued per mailbox and flushed as a single UID MOVE (or UID COPY, UID STORE and one EXPUNGE
+    when the server has no MOVE support) when another mailbox is selected or the session is closed.
+
+    With incremental sync enabled, the UIDVALIDITY and highest processed UID of every mailbox are checkpointed so later
+    runs only search for newer messages, or skip the mailbox after a single STATUS command when nothing arrived.
+    """
+
+    def __init__(self, account: dict):
+        self.account = account
+        self.archive_folder = account['archive-folder'] if 'archive-folder' in account else None
+        self.mail: Optional[imaplib.IMAP4_SSL] = None
+        self.mailbox: Optional[str] = None
+        self.pending_archive: list[int] = []
+        self.capabilities: set[str] = set()
+        self.checkpoints = get_mail_checkpoints()
+        self.uidvalidity: Optional[int] = None
+        self.failed = False
+
+    def __enter__(self) -> 'MailSession':
+        self.mail = get_mail_client(self.account['imap']['server'], self.account['imap']['port'],
+                                    self.account['username'], self.account['password'])
+        # Servers often advertise more capabilities (such as MOVE) once authenticated
+        result, data = self.mail.capability()
+        if result == 'OK':
+            self.capabilities = set(str(data[-1], 'ascii').upper().split())
+        else:
+            self.capabilities = set(self.mail.capabilities)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        try:
+            self.flush_archive()
+        finally:
+            if self.checkpoints is not None:
+                self.checkpoints.save()
+            self.mail.logout()
+            self.mail = None
+
+    def get_checkpoint_key(self, mailbox: str) -> str:
+        return f"{self.account['name']}/{mailbox}"
+
+    def has_new_mail(self, mailbox: str) -> bool:
+        if self.checkpoints is None:
+            return True
+
+        checkpoint = self.checkpoints.get(self.get_checkpoint_key(mailbox))
+        if checkpoint is None:
+            return True
+
+        result, data = self.mail.status(mailbox, '(UIDNEXT UIDVALIDITY)')
+        if result != 'OK':
+            print(f"Failed to get status of mailbox {mailbox}: {result} - {data}")
+            return True
+
+        uidnext = UIDNEXT_PATTERN.search(data[0])
+        uidvalidity = UIDVALIDITY_PATTERN.search(data[0])
+        if uidnext is None or uidvalidity is None:
+            return True
+
+        return int(uidvalidity.group('uidvalidity')) != checkpoint['uidvalidity'] \
+            or int(uidnext.group('uidnext')) > checkpoint['last-uid'] + 1
+
+    def select(self, mailbox: str) -> None:
+        self.flush_archive()
+        result, data = self.mail.select(mailbox)
+        if result != 'OK':
+            raise RuntimeError(f"Unable to select mailbox {mailbox}: {result} - {data}")
+
+        self.mailbox = mailbox
+        self.failed = False
+        result, data = self.mail.response('UIDVALIDITY')
+        self.uidvalidity = int(data[-1]) if result == 'UIDVALIDITY' and data[-1] is not None else None
+
+    def get_last_processed_uid(self) -> Optional[int]:
+        if self.checkpoints is None or self.uidvalidity is None:
+            return None
+
+        checkpoint = self.checkpoints.get(self.get_checkpoint_key(self.mailbox))
+        if checkpoint is None or checkpoint['uidvalidity'] != self.uidvalidity:
+            return None
+
+        return checkpoint['last-uid']
+
+    def search_uids(self) -> list[int]:
+        last_uid = self.get_last_processed_uid()
+        criteria = 'ALL' if last_uid is None else f"UID {last_uid + 1}:*"
+        resp, items = self.mail.uid('SEARCH', None, criteria)
         if resp != 'OK':
-            print(f"Failed to list mailbox {mailbox}: {resp} - {items}")
-            return messages
-
-        for i in items[0].split():
-            # if host == 'imap.gmail.com':
-            #     id_pattern = GM_MSGID_PATTERN
-            #     fetch_command = '(X-GM-MSGID RFC822)'
-            # else:
-            id_pattern = UID_PATTERN
-            fetch_command = '(UID RFC822)'
-
-            resp, data = mail.fetch(i, fetch_command)
-            if resp != 'OK':
-                print(f"Failed to retrieve mail #{i} from mailbox {mailbox}: {resp} - {data}")
-                continue
-
-            if len(data) < 1 or data[0] is None or not isinstance(data[0], tuple):
-                raise RuntimeError("Unexpected mail fetch data: " + ' '.join(map(str, data)))
-
-            data_desc, msg_data = data[0]
-            match = id_pattern.match(str(data_desc, 'utf-8'))
-            if match is None:
-                print(f"Could not parse email UID from {data_desc}")
-                continue
-
-            uid = int(match.group('uid'))
-            msg = email.message_from_bytes(msg_data, policy=default)
-            if isinstance(msg, EmailMessage):
-                messages[uid] = msg
+            print(f"Failed to list mailbox {self.mailbox}: {resp} - {items}")
+            return []
+
+        uids = sorted(int(uid) for uid in items[0].split())
+        # n:* always matches the newest message, even when its UID is lower than n
+        return uids if last_uid is None else [uid for uid in uids if uid > last_uid]
+
+    def fetch_batches(self, batch_size: Optional[int] = None, mode: FetchMode = FetchMode.FULL) \
+            -> Iterator[dict[int, EmailMessage | LazyEmailMessage | RawEmailMessage]]:
+        if batch_size is None:
+            batch_size = mail_configs.get('fetch-batch-size', DEFAULT_FETCH_BATCH_SIZE)
+
+        uids = self.search_uids()
+        for i in range(0, len(uids), batch_size):
+            batch_uids = uids[i:i + batch_size]
+            if mode == FetchMode.PARTIAL:
+                messages = fetch_lazy_messages(self, to_uid_set(batch_uids))
             else:
-                raise RuntimeError("Received a message that was not type EmailMessage: " + str(msg))
+                messages = fetch_uid_set(self.mail, self.mailbox, to_uid_set(batch_uids), raw=(mode == FetchMode.RAW))
+
+            missing = set(batch_uids) - messages.keys()
+            if missing:
+                # Checkpointing the later messages would skip these for good
+                print(f"Could not fetch mail {to_uid_set(sorted(missing))} from mailbox {self.mailbox}")
+                self.mark_failed()
+            yield messages
 
-    return messages
+    def mark_processed(self, msg_uid: int) -> None:
+        if self.checkpoints is None or self.uidvalidity is None or self.failed:
+            return
 
+        key = self.get_checkpoint_key(self.mailbox)
+        last_uid = self.get_last_processed_uid()
+        if last_uid is None or msg_uid > last_uid:
+            self.checkpoints.set(key, {'uidvalidity': self.uidvalidity, 'last-uid': msg_uid})
 
-def archive_mail(host, port, username, password, mailbox, msg_uid, archive_folder):
-    with get_mail_client(host, port, username, password, mailbox) as mail:
-        if archive_folder:
-            result, data = mail.uid('COPY', msg_uid, archive_folder)
+    def mark_failed(self) -> None:
+        # Keep the checkpoint below the failed message so the next run retries it
+        self.failed = True
+
+    def archive(self, msg_uid: int) -> None:
+        self.pending_archive.append(msg_uid)
+
+    def flush_archive(self) -> None:
+        if not self.pending_archive:
+            return
+
+        uid_set = to_uid_set(self.pending_archive)
+        self.pending_archive = []
+
+        if self.archive_folder and 'MOVE' in self.capabilities:
+            result, data = self.mail.uid('MOVE', uid_set, self.archive_folder)
             if result != 'OK':
-                print(f"Failed to copy message to mailbox {archive_folder}: {result} - {data}")
-
-        # if host == 'imap.gmail.com':
-        #     #  Move it to the [Gmail]/Trash folder.
-        #     #  Delete it from the [Gmail]/Trash folder.
-        #     result, data = mail.uid('STORE', msg_uid, '+X-GM-LABELS', r"(\Trash)")
-        #     if result != 'OK':
-        #         print(f"Unable to move GMail email to trash: {result} - {data}")
-        #
-        #     result, data = mail.select(r"(\Trash)")
-        #     if result != 'OK':
-        #         print(f"Unable to select mailbox {mailbox}: {result} - {data}")
-
-        result, data = mail.uid('STORE', str(msg_uid), '+FLAGS', r'(\Deleted)')
+                print(f"Failed to move messages to mailbox {self.archive_folder}: {result} - {data}")
+            return
+
+        if self.archive_folder:
+            result, data = self.mail.uid('COPY', uid_set, self.archive_folder)
+            if result != 'OK':
+                print(f"Failed to copy messages to mailbox {self.archive_folder}: {result} - {data}")
+
+        result, data = self.mail.uid('STORE', uid_set, '+FLAGS', r'(\Deleted)')
         if result == 'OK':
-            mail.expunge()
+            self.mail.expunge()
         else:
-            print(f"Failed to archive email from mailbox {mailbox}: {result} - {data}")
+            print(f"Failed to archive email from mailbox {self.mailbox}: {result} - {data}")
+
+
+def has_buffered_response(mail: imaplib.IMAP4) -> bool:
+    """Whether mail.readline() has data without waiting: read ahead by its buffer, or decrypted and pending in SSL."""
+    mail.sock.setblocking(False)
+    try:
+        return len(mail.file.peek(1)) > 0
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        mail.sock.setblocking(True)
+
+
+def wait_for_response(mail: imaplib.IMAP4, timeout: float) -> bool:
+    """Waits up to timeout seconds for the server to send something.
+
+    A timeout on the socket itself can't be used: once a read timed out, the reader behind mail.readline() refuses any
+    further read.
+    """
+    if has_buffered_response(mail):
+        return True
+    readable, _, _ = select.select([mail.sock], [], [], max(timeout, 0))
+    return len(readable) > 0
+
+
+class MailboxWatcher(threading.Thread):
+    """Holds its own IMAP connection on a mailbox and reports new mail to an event queue.
+
+    Uses IMAP IDLE (RFC 2177) when the server supports it, re-issuing the IDLE command before the 29 minute server
+    timeout, and falls back to NOOP polling otherwise.
+    """
+
+    def __init__(self, account: dict, mailbox: str, events: queue.Queue, poll_interval: int):
+        super().__init__(name=f"watcher-{account['name']}-{mailbox}", daemon=True)
+        self.account = account
+        self.mailbox = mailbox
+        self.events = events
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                with MailSession(self.account) as session:
+                    session.select(self.mailbox)
+                    if 'IDLE' in session.capabilities:
+                        self.idle(session.mail)
+                    else:
+                        self.poll(session.mail)
+            except (imaplib.IMAP4.error, OSError, RuntimeError) as exc:
+                print(f"Mailbox watcher for {self.account['name']}/{self.mailbox} disconnected: {str(exc)}")
+                self.stopped.wait(WATCHER_RECONNECT_DELAY)
+
+    def notify(self) -> None:
+        self.events.put((self.account, self.mailbox))
+
+    def idle(self, mail: imaplib.IMAP4) -> None:
+        while not self.stopped.is_set():
+            has_new_mail = False
+            tag = mail._new_tag()
+            mail.send(tag + b' IDLE\r\n')
+            line = mail.readline()
+            while line.startswith(b'* '):
+                has_new_mail = has_new_mail or EXISTS_PATTERN.match(line) is not None
+                line = mail.readline()
+            if not line.startswith(b'+'):
+                raise imaplib.IMAP4.error(f"Unexpected IDLE response: {line}")
+
+            deadline = time.monotonic() + IDLE_RENEW_INTERVAL
+            while not has_new_mail and time.monotonic() < deadline:
+                if not wait_for_response(mail, deadline - time.monotonic()):
+                    continue
+                line = mail.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("Connection closed while idling")
+                has_new_mail = EXISTS_PATTERN.match(line) is not None
+
+            mail.send(b'DONE\r\n')
+            while not line.startswith(tag):
+                line = mail.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("Connection closed while leaving IDLE")
+                has_new_mail = has_new_mail or EXISTS_PATTERN.match(line) is not None
+
+            if has_new_mail:
+                self.notify()
+
+    def poll(self, mail: imaplib.IMAP4) -> None:
+        while not self.stopped.wait(self.poll_interval):
+            result, data = mail.noop()
+            if result != 'OK':
+                raise imaplib.IMAP4.error(f"Failed to poll mailbox {self.mailbox}: {result} - {data}")
+
+            result, data = mail.response('EXISTS')
+            if data[-1] is not None:
+                self.notify()
+
+
+def fetch_uid_set(mail: imaplib.IMAP4, mailbox: str, uid_set: str, raw: bool = False) \
+        -> dict[int, EmailMessage | RawEmailMessage]:
+    resp, data = mail.uid('FETCH', uid_set, '(UID RFC822)')
+    if resp != 'OK':
+        print(f"Failed to retrieve mail {uid_set} from mailbox {mailbox}: {resp} - {data}")
+        return {}
+
+    messages = {}
+    for uid, msg_data in parse_fetch_response(data):
+        if raw:
+            messages[uid] = RawEmailMessage(msg_data)
+            continue
+
+        msg = email.message_from_bytes(msg_data, policy=default)
+        if isinstance(msg, EmailMessage):
+            messages[uid] = msg
+        else:
+            raise RuntimeError("Received a message that was not type EmailMessage: " + str(msg))
+
+    # Servers may answer in any order, the checkpoint relies on the messages being processed by ascending UID
+    return dict(sorted(messages.items()))
+
+
+def parse_fetch_response(data: list) -> Iterator[tuple[int, bytes]]:
+    # imaplib returns each message as a (description, literal) tuple followed by the closing bytes of the response,
+    # which is where the UID ends up when the server sends it after the literal
+    for i, item in enumerate(data):
+        if not isinstance(item, tuple):
+            continue
+
+        data_desc, msg_data = item
+        match = UID_PATTERN.search(data_desc)
+        if match is None and i + 1 < len(data) and isinstance(data[i + 1], bytes):
+            match = UID_PATTERN.search(data[i + 1])
+        if match is None:
+            print(f"Could not parse email UID from {data_desc}")
+            continue
+
+        yield int(match.group('uid')), msg_data
+
+
+def to_uid_set(uids: list[int]) -> str:
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+
+    return ','.join(str(start) if start == end else f"{start}:{end}" for start, end in ranges)
 
 
 def get_subject(msg):
@@ -151,7 +556,7 @@ def determine_mime_type(filename: str, content_type: str) -> MimeType:
         return MimeType.OTHER
 
 
-def get_email_body(msg: EmailMessage) -> (str, str):
+def get_email_body(msg: EmailMessage | LazyEmailMessage) -> (str, str):
     body_part = msg.get_body(preferencelist=('html', 'plain', 'related'))
     content_type = body_part.get_content_type()
     body_content = body_part.get_content()
@@ -1,26 +1,29 @@
 import os
 import glob
+import shlex
 import tempfile
 from typing import IO
 
+from utils.attachment import local_file_path
 from utils.ocr import run_image_ocr
 
 
 def get_pdf_full_text(pdf_file_like: IO) -> str:
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmp_file_name = f"{tmpdir}/tmp.pdf"
-        with open(tmp_file_name, mode="wb") as pdf_file:
-            pdf_file.write(pdf_file_like.read())
-
-        pdf_to_text_cmd = f"pdftotext -nopgbrk -layout '{tmp_file_name}' -"
-        pdf_text = ""
-        out_pipe = os.popen(pdf_to_text_cmd, mode="r")
-        lines = out_pipe.readlines()
-        for line in lines:
-            pdf_text += '> ' + line.replace('>', r'\>')
-
-        if len(pdf_text.strip()) == 0:
-            pdfimage_cmd = f"pdfimages -tiff '{tmp_file_name}' '{tmpdir}/image'"
+    with local_file_path(pdf_file_like) as pdf_file_name:
+        return get_pdf_file_text(pdf_file_name)
+
+
+def get_pdf_file_text(pdf_file_name: str) -> str:
+    pdf_to_text_cmd = f"pdftotext -nopgbrk -layout {shlex.quote(pdf_file_name)} -"
+    pdf_text = ""
+    out_pipe = os.popen(pdf_to_text_cmd, mode="r")
+    lines = out_pipe.readlines()
+    for line in lines:
+        pdf_text += '> ' + line.replace('>', r'\>')
+
+    if len(pdf_text.strip()) == 0:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pdfimage_cmd = f"pdfimages -tiff {shlex.quote(pdf_file_name)} '{tmpdir}/image'"
             if os.system(pdfimage_cmd) != 0:
                 print("Failed to run pdfimage command")
                 return ""
@@ -30,6 +33,4 @@ def get_pdf_full_text(pdf_file_like: IO) -> str:
                 if len(image_txt) > 0:
                     pdf_text += image_txt
 
-        os.remove(tmp_file_name)
-
-        return pdf_text
+    return pdf_text
@@ -0,0 +1,53 @@
+import json
+import os
+import threading
+from typing import Any
+
+from configuration import state_dir
+
+
+class JsonStateStore:
+    """Small key/value store persisted as a JSON file in the state directory (next to config.yml by default)."""
+
+    def __init__(self, file_name: str):
+        self.file_path = os.path.join(state_dir, file_name)
+        self.lock = threading.RLock()
+        self.data: dict[str, Any] = {}
+        self.dirty = False
+        if os.path.exists(self.file_path):
+            with open(self.file_path, 'r') as f:
+                try:
+                    self.data = json.load(f)
+                except ValueError:
+                    print(f"Warning: ignoring corrupt state file {self.file_path}")
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self.lock:
+            return self.data[key] if key in self.data else default
+
+    def set(self, key: str, value: Any) -> None:
+        with self.lock:
+            self.data[key] = value
+            self.dirty = True
+
+    def items(self) -> list[tuple[str, Any]]:
+        with self.lock:
+            return list(self.data.items())
+
+    def delete(self, key: str) -> None:
+        with self.lock:
+            if key in self.data:
+                del self.data[key]
+                self.dirty = True
+
+    def save(self) -> None:
+        with self.lock:
+            if not self.dirty:
+                return
+
+            # Write to a temporary file first so an interrupted run never leaves a truncated state file
+            tmp_file_path = self.file_path + '.tmp'
+            with open(tmp_file_path, 'w') as f:
+                json.dump(self.data, f, indent=1, sort_keys=True)
+            os.replace(tmp_file_path, self.file_path)
+            self.dirty = False